@@ -72,14 +72,19 @@ import asyncio
 import json
 import sys
 from datetime import date
-from typing import Any, Dict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List
 import os
-import requests
+import random
+
+import httpx
 
 from openai import OpenAI
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
+from app.registry import METRICS
+
 
 # client = OpenAI()
 
@@ -90,78 +95,237 @@ SERVER = StdioServerParameters(
 )
 
 
+TOOL_NAMES = set(METRICS)
+
+
 def select_model(question: str) -> str:
     if len(question) > 200:
         return "gpt-4.1"
     return "gpt-4.1-mini"
 
 
-def plan_tool(question: str):
+def _tool_list() -> str:
+    # generated from the metric registry, so it can't drift from the server
+    lines = []
+    for number, metric in enumerate(METRICS.values(), 1):
+        lines.append(f"{number}) {metric.name}: {metric.summary}")
+        lines.append(f"   args: {', '.join(param.describe() for param in metric.params)}")
+        if metric.planner_hint:
+            lines.append(f"   {metric.planner_hint}")
+    return "\n".join(lines)
+
+
+def planner_system_prompt() -> str:
     today = date.today().isoformat()
 
     system = (
-        "You are a router that maps user analytics questions to exactly one MCP tool "
-        "and a JSON arguments object.\n\n"
+        "You are a router that maps user analytics questions to the MCP tool calls "
+        "that answer them, each with a JSON arguments object.\n\n"
         "TOOLS:\n"
-        "1) activation_rate\n"
-        "   args: cohort_start (YYYY-MM-DD), cohort_end (YYYY-MM-DD)\n"
-        "2) wau_by_plan\n"
-        "   args: start_date, end_date\n"
-        "3) feature_timeseries\n"
-        "   args: event_name, start_date, end_date\n"
-        "4) conversion_by_channel\n"
-        "   args: cohort_start, cohort_end\n"
-        "5) feature_usage_by_segment\n"
-        '   args: plan_tier (\"free\"|\"pro\"|\"enterprise\"), start_date, end_date\n'
-        "6) country_wow_change\n"
-        "   args: week0_start, week1_start, drop_threshold (e.g. 0.2)\n\n"
+        f"{_tool_list()}\n\n"
+        "Every tool also accepts optional segment filters: country, plan_tier, "
+        "acquisition_channel, company_id, min_employees, max_employees.\n\n"
         f"Rules:\n"
         f"- Today is {today}.\n"
         "- Use ISO dates only.\n"
-        "- Choose exactly ONE tool_name from the list.\n"
-        "- Always return ONLY valid JSON of the form:\n"
+        "- If one tool answers the question, return ONLY valid JSON of the form:\n"
         "{\"tool_name\": \"...\", \"arguments\": { ... }}\n"
+        "- For compound questions (e.g. comparing metrics), return ONLY valid JSON of the form:\n"
+        "{\"calls\": [{\"id\": \"a\", \"tool_name\": \"...\", \"arguments\": { ... }}, ...]}\n"
+        "  All calls run concurrently, so each call's arguments must be complete on "
+        "their own.\n"
     )
-
-    prompt = system + "\nUser question:\n" + question + "\nJSON output only:\n"
-
-    api_key = os.environ.get("XAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("XAI_API_KEY is not set")
-
-    resp = requests.post(
-        "https://api.x.ai/v1/chat/completions",
-        headers={
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        },
-        json={
-            "model": "grok-3-mini",
-            "messages": [
-                {"role": "system", "content": system},
+    return system
+
+
+class PlannerClient:
+    """Async chat-completions client for the planner.
+
+    One pooled httpx.AsyncClient is kept for the life of the planner, so
+    repeated questions reuse keep-alive connections. Each request gets
+    `attempt_timeout` seconds and all attempts together share `budget`
+    seconds; connection errors, timeouts, 429 and 5xx are retried with
+    full-jitter exponential backoff.
+    """
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = "https://api.x.ai/v1",
+        model: str = "grok-3-mini",
+        budget: float = 60.0,
+        attempt_timeout: float = 20.0,
+        max_attempts: int = 4,
+        backoff: float = 0.5,
+        max_connections: int = 10,
+    ):
+        self.model = model
+        self.budget = budget
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            },
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=attempt_timeout,
+        )
+
+    @classmethod
+    def from_env(cls) -> "PlannerClient":
+        api_key = os.environ.get("XAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("XAI_API_KEY is not set")
+        return cls(
+            api_key,
+            base_url=os.environ.get("XAI_BASE_URL", "https://api.x.ai/v1"),
+            budget=float(os.environ.get("PLANNER_TIMEOUT_BUDGET", "60")),
+        )
+
+    async def __aenter__(self) -> "PlannerClient":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+    async def complete(self, messages: List[Dict[str, str]]) -> str:
+        body = {"model": self.model, "messages": messages, "temperature": 0}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.budget
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise TimeoutError(f"Planner budget of {self.budget}s exhausted")
+            try:
+                resp = await self._client.post(
+                    "/chat/completions",
+                    json=body,
+                    timeout=min(self.attempt_timeout, remaining),
+                )
+                if resp.status_code not in self.RETRY_STATUS:
+                    resp.raise_for_status()
+                    return resp.json()["choices"][0]["message"]["content"]
+                error: Exception = httpx.HTTPStatusError(
+                    f"Planner returned {resp.status_code}",
+                    request=resp.request,
+                    response=resp,
+                )
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                error = e
+
+            if attempt >= self.max_attempts:
+                raise error
+            delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+            if loop.time() + delay >= deadline:
+                raise error
+            await asyncio.sleep(delay)
+
+    async def plan(self, question: str) -> Dict[str, Any]:
+        text = await self.complete(
+            [
+                {"role": "system", "content": planner_system_prompt()},
                 {"role": "user", "content": question},
-            ],
-            "temperature": 0,
-        },
-        timeout=60,
-    )
-    resp.raise_for_status()
-    text = resp.json()["choices"][0]["message"]["content"]
-    return json.loads(text)
+            ]
+        )
+        return json.loads(text)
 
-async def run_tool(tool_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+
+def plan_tool(question: str):
+    async def _plan():
+        async with PlannerClient.from_env() as planner:
+            return await planner.plan(question)
+
+    return asyncio.run(_plan())
+
+
+def plan_calls(plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # Accepts the single-tool form or {"calls": [...]}; returns independent calls.
+    raw_calls = plan.get("calls")
+    if raw_calls is None:
+        raw_calls = [
+            {
+                "id": "1",
+                "tool_name": plan.get("tool_name"),
+                "arguments": plan.get("arguments", {}),
+            }
+        ]
+    calls = []
+    seen = set()
+    for i, call in enumerate(raw_calls):
+        call_id = str(call.get("id", i + 1))
+        # results are keyed by id
+        if call_id in seen:
+            raise ValueError(f"Plan has more than one call with id {call_id!r}")
+        seen.add(call_id)
+        calls.append(
+            {
+                "id": call_id,
+                "tool_name": call.get("tool_name"),
+                "arguments": call.get("arguments") or {},
+            }
+        )
+    return calls
+
+
+@asynccontextmanager
+async def open_session():
     async with stdio_client(SERVER) as (read, write):
         async with ClientSession(read, write) as session:
             await session.initialize()
-            result = await session.call_tool(tool_name, arguments)
-            if result.structuredContent is not None:
-                return result.structuredContent
-            if result.content and hasattr(result.content[0], "text"):
-                try:
-                    return json.loads(result.content[0].text)
-                except Exception:
-                    return {"raw": result.content[0].text}
-            return {}
+            yield session
+
+
+async def call_tool(
+    session: ClientSession, tool_name: str, arguments: Dict[str, Any]
+) -> Dict[str, Any]:
+    result = await session.call_tool(tool_name, arguments)
+    if result.structuredContent is not None:
+        return result.structuredContent
+    if result.content and hasattr(result.content[0], "text"):
+        try:
+            return json.loads(result.content[0].text)
+        except Exception:
+            return {"raw": result.content[0].text}
+    return {}
+
+
+async def run_tool(tool_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    async with open_session() as session:
+        return await call_tool(session, tool_name, arguments)
+
+
+async def execute_plan(
+    session: ClientSession, calls: List[Dict[str, Any]]
+) -> Dict[str, Any]:
+    # No call reads another's output, so every call is issued at once over
+    # the one session.
+    outputs = await asyncio.gather(
+        *(call_tool(session, c["tool_name"], c["arguments"]) for c in calls)
+    )
+    return {call["id"]: output for call, output in zip(calls, outputs)}
+
+
+async def execute_plan_sequential(
+    session: ClientSession, calls: List[Dict[str, Any]]
+) -> Dict[str, Any]:
+    # Baseline for measuring the concurrent executor.
+    results: Dict[str, Any] = {}
+    for call in calls:
+        results[call["id"]] = await call_tool(session, call["tool_name"], call["arguments"])
+    return results
 
 
 def format_answer(
@@ -252,31 +416,51 @@ async def main():
         "time series",
         "usage",
         "cohort",
+        "account",
+        "company",
+        "seat",
+        "retention",
+        "funnel",
+        "anomal",
+        "drop",
+        "spike",
+        "changed",
     ]
 
     if not any(k in q_lower for k in analytics_keywords):
         print("This agent only answers analytics questions about product usage, activation, WAU, features, conversion, and country-level trends.")
         return
 
-    plan = plan_tool(question)
-    tool_name = plan.get("tool_name")
-    arguments = plan.get("arguments", {})
-
-    if tool_name not in {
-        "activation_rate",
-        "wau_by_plan",
-        "feature_timeseries",
-        "conversion_by_channel",
-        "feature_usage_by_segment",
-        "country_wow_change",
-    }:
-        print("Planner could not map this question to a supported analytics tool.")
-        print(plan)
+    # Plan while the MCP server starts up and initializes.
+    async with PlannerClient.from_env() as planner:
+        plan_task = asyncio.create_task(planner.plan(question))
+        try:
+            async with open_session() as session:
+                plan = await plan_task
+                try:
+                    calls = plan_calls(plan)
+                except ValueError:
+                    calls = []
+
+                if not calls or any(c["tool_name"] not in TOOL_NAMES for c in calls):
+                    print("Planner could not map this question to a supported analytics tool.")
+                    print(plan)
+                    return
+
+                results = await execute_plan(session, calls)
+        finally:
+            plan_task.cancel()
+
+    if len(calls) == 1:
+        call = calls[0]
+        print(format_answer(question, call["tool_name"], call["arguments"], results[call["id"]]))
         return
 
-    data = await run_tool(tool_name, arguments)
-    text = format_answer(question, tool_name, arguments, data)
-    print(text)
+    sections = []
+    for call in calls:
+        text = format_answer(question, call["tool_name"], call["arguments"], results[call["id"]])
+        sections.append(f"## {call['tool_name']} {json.dumps(call['arguments'])}\n{text}")
+    print("\n\n".join(sections))
 
 
 if __name__ == "__main__":
@@ -1,11 +1,24 @@
+from dataclasses import replace
 from datetime import datetime, date, timedelta
 from collections import defaultdict
-from typing import Dict, List, Tuple
+from math import sqrt
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
+from sqlalchemy import Integer, case, cast, distinct, func, literal, or_, select, union_all
 from sqlalchemy.orm import Session
 
+from .buckets import day_from_number, day_number
 from .db import SessionLocal
-from .models import Users, Events
+from .models import Users, Companies, Events, EventRollups, PROMOTED_METADATA_COLUMNS
+from .filters import (
+    SegmentFilter,
+    USER_DIMENSIONS,
+    filter_events,
+    filter_users,
+    user_dimension,
+)
+from .sampling import SAMPLE_BUCKETS, in_sample, sample_buckets, scale, wilson_interval
+from .shards import scatter
 
 
 def get_db() -> Session:
@@ -16,218 +29,421 @@ def _week_start(d: date) -> date:
     return d - timedelta(days=d.weekday())
 
 
-def get_activation_rate(
-    db: Session,
+def _week_start_sql(column):
+    # SQLite: step back 6 days, then forward to the next Monday
+    return func.date(column, "-6 days", "weekday 1")
+
+
+GRAIN_DAYS = {"day": 1, "week": 7}
+
+# julianday() of 1970-01-01, turning SQLite dates into app.buckets day numbers
+_JULIAN_EPOCH = 2440587.5
+
+STREAM_CHUNK_SIZE = 2000
+
+
+def _apply_metadata_filter(query, metadata_filter: Optional[Dict[str, str]], source=None):
+    if not metadata_filter:
+        return query
+    for key, value in metadata_filter.items():
+        column = PROMOTED_METADATA_COLUMNS.get(key)
+        if column is None:
+            raise ValueError(
+                f"Cannot filter on metadata key {key!r}; "
+                f"promoted keys are {sorted(PROMOTED_METADATA_COLUMNS)}"
+            )
+        if source is not None:
+            column = source.c[column.key]
+        query = query.filter(column == value)
+    return query
+
+
+def _stream(query):
+    # plain column tuples, fetched in fixed-size chunks
+    return query.yield_per(STREAM_CHUNK_SIZE)
+
+
+def _sample(query, column, buckets: Optional[int]):
+    # keep only users in the first `buckets` sample buckets (app.sampling)
+    if buckets is None:
+        return query
+    return query.filter(in_sample(column, buckets))
+
+
+def _cohort_users(
+    query,
     cohort_start: date,
     cohort_end: date,
-) -> float:
-    users = (
-        db.query(Users)
-        .filter(Users.signup_date >= cohort_start)
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int] = None,
+):
+    query = (
+        query.filter(Users.signup_date >= cohort_start)
         .filter(Users.signup_date <= cohort_end)
-        .all()
     )
-    if not users:
-        return 0.0
-
-    user_ids = [u.user_id for u in users]
-    events = (
-        db.query(Events)
-        .filter(Events.user_id.in_(user_ids))
-        .filter(Events.event_name == "view_dashboard")
-        .all()
+    return filter_users(_sample(query, Users.sample_bucket, buckets), segment)
+
+
+def _compacted_before(db: Session) -> Optional[datetime]:
+    last_day = db.query(func.max(EventRollups.event_day)).scalar()
+    return last_day + timedelta(days=1) if last_day is not None else None
+
+
+def _reads_rollups(db: Session, since: date) -> bool:
+    # Rollups are stamped at the UTC midnight of their day but keep the raw
+    # rows' reporting-timezone buckets, which can run a day past it; a
+    # source read by either column needs them if either reaches `since`.
+    compacted_before = _compacted_before(db)
+    if compacted_before is None:
+        return False
+    if datetime.combine(since, datetime.min.time()) < compacted_before:
+        return True
+    last_bucket = db.query(func.max(EventRollups.bucket_day)).scalar()
+    return last_bucket is not None and last_bucket >= day_number(since)
+
+
+def _event_source(db: Session, since: date, buckets: Optional[int] = None):
+    """Events as (user_id, event_name, event_time, meta_format, meta_platform,
+    event_count, event_day, event_week) rows, limited to the users in the
+    first `buckets` sample buckets when given.
+
+    Days compacted by app.retention come from event_rollups, stamped at
+    midnight and weighted by event_count; the union is only built when
+    `since` reaches back into them, by UTC day or by reporting day.
+    """
+    raw = select(
+        Events.user_id,
+        Events.event_name,
+        Events.event_time,
+        Events.meta_format,
+        Events.meta_platform,
+        literal(1).label("event_count"),
+        Events.event_day,
+        Events.event_week,
+    )
+    if buckets is not None:
+        raw = raw.where(in_sample(Events.sample_bucket, buckets))
+    if not _reads_rollups(db, since):
+        return raw.subquery("events_source")
+    rolled = select(
+        EventRollups.user_id,
+        EventRollups.event_name,
+        EventRollups.event_day,
+        EventRollups.meta_format,
+        EventRollups.meta_platform,
+        EventRollups.event_count,
+        EventRollups.bucket_day,
+        EventRollups.bucket_week,
     )
+    if buckets is not None:
+        rolled = rolled.where(in_sample(EventRollups.sample_bucket, buckets))
+    return union_all(raw, rolled).subquery("events_source")
 
-    events_by_user: Dict[str, List[Events]] = defaultdict(list)
-    for e in events:
-        events_by_user[e.user_id].append(e)
 
-    activated = 0
-    for u in users:
-        signup_dt = datetime.combine(u.signup_date, datetime.min.time())
-        cutoff = signup_dt + timedelta(days=7)
-        has_activation = any(
-            signup_dt <= e.event_time < cutoff for e in events_by_user[u.user_id]
-        )
-        if has_activation:
-            activated += 1
+# Every metric runs a *_partial query on each shard (app.shards.scatter)
+# and merges the results here. A user and all of their events live on one
+# shard, so per-user counts, distinct users included, add up exactly across
+# shards; anything counted per company is merged by company, never summed.
 
-    return activated / len(users)
 
+def _sum_counts(partials) -> Dict:
+    total: Dict = {}
+    for partial in partials:
+        for key, value in partial.items():
+            total[key] = total.get(key, 0) + value
+    return total
 
-def get_wau_by_plan(
+
+def _sum_series(partials) -> Dict:
+    total: Dict = {}
+    for partial in partials:
+        for key, values in partial.items():
+            if key in total:
+                total[key] = [a + b for a, b in zip(total[key], values)]
+            else:
+                total[key] = list(values)
+    return total
+
+
+def _activation_partial(
     db: Session,
-    start_date: date,
-    end_date: date,
-) -> List[Dict]:
-    events = (
-        db.query(Events)
-        .filter(Events.event_time >= datetime.combine(start_date, datetime.min.time()))
-        .filter(Events.event_time < datetime.combine(end_date, datetime.min.time()))
-        .all()
+    cohort_start: date,
+    cohort_end: date,
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int],
+) -> Tuple[int, int]:
+    total = _cohort_users(
+        db.query(func.count()).select_from(Users), cohort_start, cohort_end, segment, buckets
+    ).scalar()
+    if not total:
+        return 0, 0
+
+    ev = _event_source(db, cohort_start, buckets)
+    query = (
+        db.query(func.count(distinct(ev.c.user_id)))
+        .select_from(ev)
+        .join(Users, Users.user_id == ev.c.user_id)
+        .filter(ev.c.event_name == "view_dashboard")
+        .filter(ev.c.event_time >= func.datetime(Users.signup_date))
+        .filter(ev.c.event_time < func.datetime(Users.signup_date, "+7 days"))
     )
+    activated = _cohort_users(query, cohort_start, cohort_end, segment, buckets).scalar()
+    return activated, total
+
+
+class SampledRate(NamedTuple):
+    rate: float
+    ci: List[float]
+
+
+def get_activation_rate(
+    db: Session,
+    cohort_start: date,
+    cohort_end: date,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
+) -> Union[float, SampledRate]:
+    buckets = sample_buckets(sample_rate)
+    activated = total = 0
+    for shard_activated, shard_total in scatter(
+        db, _activation_partial, cohort_start, cohort_end, segment, buckets
+    ):
+        activated += shard_activated
+        total += shard_total
+    rate = activated / total if total else 0.0
+    if buckets is not None:
+        return SampledRate(rate, wilson_interval(activated, total))
+
+    return rate
 
-    user_ids = list({e.user_id for e in events})
-    users = (
-        db.query(Users)
-        .filter(Users.user_id.in_(user_ids))
-        .all()
+
+def _wau_by_plan_partial(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int],
+) -> Dict[Tuple[int, str], int]:
+    ev = _event_source(db, start_date, buckets)
+    query = (
+        db.query(ev.c.event_week, Users.plan_tier, func.count(distinct(ev.c.user_id)))
+        .join(Users, Users.user_id == ev.c.user_id)
+        .filter(ev.c.event_day >= day_number(start_date))
+        .filter(ev.c.event_day < day_number(end_date))
+        .filter(Users.plan_tier.isnot(None))
     )
-    plan_by_user = {u.user_id: u.plan_tier for u in users}
+    rows = filter_users(query, segment).group_by(ev.c.event_week, Users.plan_tier).all()
+    return {(week, plan): count for week, plan, count in rows}
 
-    buckets: Dict[Tuple[date, str], set] = defaultdict(set)
 
-    for e in events:
-        d = e.event_time.date()
-        w_start = _week_start(d)
-        plan = plan_by_user.get(e.user_id)
-        if plan is None:
-            continue
-        buckets[(w_start, plan)].add(e.user_id)
+def get_wau_by_plan(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
+) -> List[Dict]:
+    buckets = sample_buckets(sample_rate)
+    wau = _sum_counts(
+        scatter(db, _wau_by_plan_partial, start_date, end_date, segment, buckets)
+    )
 
     result = []
-    for (w_start, plan), users_set in sorted(buckets.items(), key=lambda x: (x[0][0], x[0][1])):
+    for (week, plan), count in sorted(wau.items()):
         result.append(
             {
-                "week_start": w_start.isoformat(),
+                "week_start": day_from_number(week).isoformat(),
                 "plan_tier": plan,
-                "wau": len(users_set),
+                "wau": scale(count, buckets),
             }
         )
     return result
 
 
+def _feature_timeseries_partial(
+    db: Session,
+    event_name: str,
+    start_date: date,
+    end_date: date,
+    metadata_filter: Optional[Dict[str, str]],
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int],
+) -> Dict[int, int]:
+    ev = _event_source(db, start_date, buckets)
+    # SQLite favours ix_events_name_day_user for its day range and GROUP BY
+    # order, reading every event in the range; "+ 0" hides the column so a
+    # sample is read through the (event_name, sample_bucket) indexes instead
+    day = ev.c.event_day if buckets is None else ev.c.event_day + 0
+    query = (
+        db.query(day, func.sum(ev.c.event_count))
+        .filter(ev.c.event_name == event_name)
+        .filter(day >= day_number(start_date))
+        .filter(day < day_number(end_date))
+    )
+    query = _apply_metadata_filter(
+        filter_events(query, segment, ev.c.user_id), metadata_filter, ev
+    )
+    return dict(query.group_by(day).all())
+
+
 def get_feature_timeseries(
     db: Session,
     event_name: str,
     start_date: date,
     end_date: date,
+    metadata_filter: Optional[Dict[str, str]] = None,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
 ) -> List[Dict]:
-    events = (
-        db.query(Events)
-        .filter(Events.event_name == event_name)
-        .filter(Events.event_time >= datetime.combine(start_date, datetime.min.time()))
-        .filter(Events.event_time < datetime.combine(end_date, datetime.min.time()))
-        .all()
+    buckets = sample_buckets(sample_rate)
+    counts = _sum_counts(
+        scatter(
+            db,
+            _feature_timeseries_partial,
+            event_name,
+            start_date,
+            end_date,
+            metadata_filter,
+            segment,
+            buckets,
+        )
     )
 
-    counts: Dict[date, int] = defaultdict(int)
-    for e in events:
-        d = e.event_time.date()
-        counts[d] += 1
-
     result = []
-    for d, c in sorted(counts.items(), key=lambda x: x[0]):
+    for d, c in sorted(counts.items()):
         result.append(
             {
-                "date": d.isoformat(),
+                "date": day_from_number(d).isoformat(),
                 "event_name": event_name,
-                "count": c,
+                "count": scale(c, buckets),
             }
         )
     return result
 
 
-def get_conversion_by_channel(
+def _conversion_partial(
     db: Session,
     cohort_start: date,
     cohort_end: date,
-) -> List[Dict]:
-    users = (
-        db.query(Users)
-        .filter(Users.signup_date >= cohort_start)
-        .filter(Users.signup_date <= cohort_end)
-        .all()
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int],
+) -> Tuple[Dict[str, int], Dict[str, int]]:
+    cohort_query = _cohort_users(
+        db.query(Users.acquisition_channel, func.count()),
+        cohort_start,
+        cohort_end,
+        segment,
+        buckets,
     )
-    if not users:
-        return []
+    cohort_by_channel = dict(cohort_query.group_by(Users.acquisition_channel).all())
+    if not cohort_by_channel:
+        return {}, {}
 
-    user_ids = [u.user_id for u in users]
-    signup_by_user = {u.user_id: u.signup_date for u in users}
-    channel_by_user = {u.user_id: u.acquisition_channel for u in users}
-
-    events = (
-        db.query(Events)
-        .filter(Events.user_id.in_(user_ids))
-        .filter(Events.event_name == "upgrade_plan")
-        .all()
+    # the last cohort day's 30-day window bounds the event range
+    ev = _event_source(db, cohort_start, buckets)
+    query = (
+        db.query(Users.acquisition_channel, func.count(distinct(ev.c.user_id)))
+        .select_from(ev)
+        .join(Users, Users.user_id == ev.c.user_id)
+        .filter(ev.c.event_name == "upgrade_plan")
+        .filter(ev.c.event_time >= datetime.combine(cohort_start, datetime.min.time()))
+        .filter(
+            ev.c.event_time
+            < datetime.combine(cohort_end, datetime.min.time()) + timedelta(days=30)
+        )
+        .filter(ev.c.event_time >= func.datetime(Users.signup_date))
+        .filter(ev.c.event_time < func.datetime(Users.signup_date, "+30 days"))
+        .filter(Users.acquisition_channel.isnot(None))
     )
+    query = _cohort_users(query, cohort_start, cohort_end, segment, buckets)
+    return cohort_by_channel, dict(query.group_by(Users.acquisition_channel).all())
 
-    converted_users_by_channel: Dict[str, set] = defaultdict(set)
 
-    for e in events:
-        uid = e.user_id
-        signup_date = signup_by_user.get(uid)
-        if signup_date is None:
-            continue
-        start_dt = datetime.combine(signup_date, datetime.min.time())
-        cutoff = start_dt + timedelta(days=30)
-        if start_dt <= e.event_time < cutoff:
-            ch = channel_by_user.get(uid)
-            if ch is not None:
-                converted_users_by_channel[ch].add(uid)
-
-    cohort_by_channel: Dict[str, set] = defaultdict(set)
-    for u in users:
-        cohort_by_channel[u.acquisition_channel].add(u.user_id)
+def get_conversion_by_channel(
+    db: Session,
+    cohort_start: date,
+    cohort_end: date,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
+) -> List[Dict]:
+    buckets = sample_buckets(sample_rate)
+    partials = scatter(db, _conversion_partial, cohort_start, cohort_end, segment, buckets)
+    cohort_by_channel = _sum_counts(cohort for cohort, _ in partials)
+    converted_by_channel = _sum_counts(converted for _, converted in partials)
+    if not cohort_by_channel:
+        return []
 
     result = []
-    for ch, cohort_users in cohort_by_channel.items():
-        converted = converted_users_by_channel.get(ch, set())
-        total = len(cohort_users)
+    for ch, total in cohort_by_channel.items():
+        converted = converted_by_channel.get(ch, 0)
         if total == 0:
             rate = 0.0
         else:
-            rate = len(converted) / total
-        result.append(
-            {
-                "acquisition_channel": ch,
-                "cohort_size": total,
-                "converted": len(converted),
-                "conversion_rate_30d": rate,
-            }
-        )
+            rate = converted / total
+        item = {
+            "acquisition_channel": ch,
+            "cohort_size": scale(total, buckets),
+            "converted": scale(converted, buckets),
+            "conversion_rate_30d": rate,
+        }
+        if buckets is not None:
+            item["conversion_rate_30d_ci"] = wilson_interval(converted, total)
+        result.append(item)
     return sorted(result, key=lambda x: x["acquisition_channel"])
 
 
-def get_feature_usage_by_segment(
+def _feature_usage_partial(
     db: Session,
-    plan_tier: str,
     start_date: date,
     end_date: date,
-) -> List[Dict]:
-    users = (
-        db.query(Users)
-        .filter(Users.plan_tier == plan_tier)
-        .all()
+    metadata_filter: Optional[Dict[str, str]],
+    segment: SegmentFilter,
+    buckets: Optional[int],
+) -> Tuple[Dict[str, int], Dict[str, int]]:
+    ev = _event_source(db, start_date, buckets)
+    query = (
+        db.query(ev.c.event_name, ev.c.user_id, ev.c.event_count)
+        .filter(ev.c.event_day >= day_number(start_date))
+        .filter(ev.c.event_day < day_number(end_date))
     )
-    if not users:
-        return []
-
-    user_ids = [u.user_id for u in users]
-
-    events = (
-        db.query(Events)
-        .filter(Events.user_id.in_(user_ids))
-        .filter(Events.event_time >= datetime.combine(start_date, datetime.min.time()))
-        .filter(Events.event_time < datetime.combine(end_date, datetime.min.time()))
-        .all()
+    query = _apply_metadata_filter(
+        filter_events(query, segment, ev.c.user_id), metadata_filter, ev
     )
 
     counts: Dict[str, int] = defaultdict(int)
     users_by_event: Dict[str, set] = defaultdict(set)
 
-    for e in events:
-        counts[e.event_name] += 1
-        users_by_event[e.event_name].add(e.user_id)
+    for event_name, user_id, event_count in _stream(query):
+        counts[event_name] += event_count
+        users_by_event[event_name].add(user_id)
+
+    return dict(counts), {name: len(users) for name, users in users_by_event.items()}
+
+
+def get_feature_usage_by_segment(
+    db: Session,
+    plan_tier: str,
+    start_date: date,
+    end_date: date,
+    metadata_filter: Optional[Dict[str, str]] = None,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
+) -> List[Dict]:
+    segment = replace(segment or SegmentFilter(), plan_tier=plan_tier)
+    buckets = sample_buckets(sample_rate)
+    partials = scatter(
+        db, _feature_usage_partial, start_date, end_date, metadata_filter, segment, buckets
+    )
+    counts = _sum_counts(counts for counts, _ in partials)
+    distinct_users = _sum_counts(users for _, users in partials)
 
     result = []
     for event_name, total_count in counts.items():
         result.append(
             {
                 "event_name": event_name,
-                "total_events": total_count,
-                "distinct_users": len(users_by_event[event_name]),
+                "total_events": scale(total_count, buckets),
+                "distinct_users": scale(distinct_users[event_name], buckets),
             }
         )
 
@@ -235,49 +451,60 @@ def get_feature_usage_by_segment(
     return result
 
 
-def get_country_wow_change(
+def _country_wow_partial(
     db: Session,
     week0_start: date,
     week1_start: date,
-    drop_threshold: float = 0.2,
-) -> List[Dict]:
-    week0_end = week0_start + timedelta(days=7)
-    week1_end = week1_start + timedelta(days=7)
-
-    events = (
-        db.query(Events)
-        .filter(Events.event_time >= datetime.combine(week0_start, datetime.min.time()))
-        .filter(Events.event_time < datetime.combine(week1_end, datetime.min.time()))
-        .all()
-    )
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int],
+) -> Tuple[Dict[str, int], Dict[str, int]]:
+    w0_start, w0_end = day_number(week0_start), day_number(week0_start) + 7
+    w1_start, w1_end = day_number(week1_start), day_number(week1_start) + 7
 
-    user_ids = list({e.user_id for e in events})
-    users = (
-        db.query(Users)
-        .filter(Users.user_id.in_(user_ids))
-        .all()
+    ev = _event_source(db, week0_start, buckets)
+    query = (
+        db.query(ev.c.user_id, ev.c.event_day, Users.country)
+        .join(Users, Users.user_id == ev.c.user_id)
+        .filter(ev.c.event_day >= w0_start)
+        .filter(ev.c.event_day < w1_end)
     )
-    country_by_user = {u.user_id: u.country for u in users}
 
     wau_week0: Dict[str, set] = defaultdict(set)
     wau_week1: Dict[str, set] = defaultdict(set)
 
-    for e in events:
-        d = e.event_time.date()
-        country = country_by_user.get(e.user_id)
+    for user_id, d, country in _stream(filter_users(query, segment)):
         if country is None:
             continue
-        if week0_start <= d < week0_end:
-            wau_week0[country].add(e.user_id)
-        elif week1_start <= d < week1_end:
-            wau_week1[country].add(e.user_id)
+        if w0_start <= d < w0_end:
+            wau_week0[country].add(user_id)
+        elif w1_start <= d < w1_end:
+            wau_week1[country].add(user_id)
+
+    return (
+        {c: len(users) for c, users in wau_week0.items()},
+        {c: len(users) for c, users in wau_week1.items()},
+    )
+
+
+def get_country_wow_change(
+    db: Session,
+    week0_start: date,
+    week1_start: date,
+    drop_threshold: float = 0.2,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
+) -> List[Dict]:
+    buckets = sample_buckets(sample_rate)
+    partials = scatter(db, _country_wow_partial, week0_start, week1_start, segment, buckets)
+    wau_week0 = _sum_counts(week0 for week0, _ in partials)
+    wau_week1 = _sum_counts(week1 for _, week1 in partials)
 
     result = []
     countries = set(list(wau_week0.keys()) + list(wau_week1.keys()))
 
     for c in countries:
-        w0 = len(wau_week0.get(c, set()))
-        w1 = len(wau_week1.get(c, set()))
+        w0 = wau_week0.get(c, 0)
+        w1 = wau_week1.get(c, 0)
         if w0 == 0:
             change_pct = None
         else:
@@ -286,8 +513,8 @@ def get_country_wow_change(
             result.append(
                 {
                     "country": c,
-                    "wau_week0": w0,
-                    "wau_week1": w1,
+                    "wau_week0": scale(w0, buckets),
+                    "wau_week1": scale(w1, buckets),
                     "change_pct": change_pct,
                 }
             )
@@ -296,6 +523,526 @@ def get_country_wow_change(
     return result
 
 
+def _active_accounts_partial(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int],
+) -> Dict[Tuple[int, str], int]:
+    # per (week, company): a company's users may sit on several shards
+    ev = _event_source(db, start_date, buckets)
+    query = (
+        db.query(ev.c.event_week, Users.company_id, func.count(distinct(ev.c.user_id)))
+        .join(Users, Users.user_id == ev.c.user_id)
+        .filter(ev.c.event_day >= day_number(start_date))
+        .filter(ev.c.event_day < day_number(end_date))
+        .filter(Users.company_id.isnot(None))
+    )
+    rows = filter_users(query, segment).group_by(ev.c.event_week, Users.company_id).all()
+    return {(week, company_id): active for week, company_id, active in rows}
+
+
+def get_weekly_active_accounts(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
+) -> List[Dict]:
+    # sampled: accounts with any sampled active user, not scaled; at low
+    # rates this undercounts accounts with few active users
+    buckets = sample_buckets(sample_rate)
+    active = _sum_counts(
+        scatter(db, _active_accounts_partial, start_date, end_date, segment, buckets)
+    )
+    accounts: Dict[int, int] = defaultdict(int)
+    active_users: Dict[int, int] = defaultdict(int)
+    for (week, _), users in active.items():
+        accounts[week] += 1
+        active_users[week] += users
+
+    return [
+        {
+            "week_start": day_from_number(week).isoformat(),
+            "active_accounts": accounts[week],
+            "active_users": scale(active_users[week], buckets),
+        }
+        for week in sorted(accounts)
+    ]
+
+
+def _active_seats_partial(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int],
+) -> Tuple[Dict[str, int], Dict[str, int], Dict[str, Tuple[str, int]]]:
+    seats_query = _sample(db.query(Users.company_id, func.count()), Users.sample_bucket, buckets)
+    seats = dict(filter_users(seats_query, segment).group_by(Users.company_id).all())
+    ev = _event_source(db, start_date, buckets)
+    query = (
+        db.query(
+            Companies.company_id,
+            Companies.company_name,
+            Companies.employee_count,
+            func.count(distinct(ev.c.user_id)),
+        )
+        .select_from(ev)
+        .join(Users, Users.user_id == ev.c.user_id)
+        .join(Companies, Companies.company_id == Users.company_id)
+        .filter(ev.c.event_day >= day_number(start_date))
+        .filter(ev.c.event_day < day_number(end_date))
+    )
+    rows = filter_users(query, segment).group_by(Companies.company_id).all()
+    active = {company_id: n for company_id, _, _, n in rows}
+    companies = {company_id: (name, employees) for company_id, name, employees, _ in rows}
+    return seats, active, companies
+
+
+def get_company_active_seats(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    limit: int = 100,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
+) -> List[Dict]:
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+    buckets = sample_buckets(sample_rate)
+    partials = scatter(db, _active_seats_partial, start_date, end_date, segment, buckets)
+    seats = _sum_counts(shard_seats for shard_seats, _, _ in partials)
+    active = _sum_counts(shard_active for _, shard_active, _ in partials)
+    companies: Dict[str, Tuple[str, int]] = {}
+    for _, _, shard_companies in partials:
+        companies.update(shard_companies)
+    top = sorted(active.items(), key=lambda x: (-x[1], x[0]))[:limit]
+
+    result = []
+    for company_id, active_seats in top:
+        company_name, employee_count = companies[company_id]
+        total_seats = seats[company_id]
+        item = {
+            "company_id": company_id,
+            "company_name": company_name,
+            "employee_count": employee_count,
+            "seats": scale(total_seats, buckets),
+            "active_seats": scale(active_seats, buckets),
+            "seat_utilization": active_seats / total_seats if total_seats else 0.0,
+        }
+        if buckets is not None:
+            item["seat_utilization_ci"] = wilson_interval(active_seats, total_seats)
+        result.append(item)
+    return result
+
+
+def _company_wow_partial(
+    db: Session,
+    week0_start: date,
+    week1_start: date,
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int],
+) -> Tuple[Dict[str, str], Dict[str, int], Dict[str, int]]:
+    w0_start = day_number(week0_start)
+    w1_start = day_number(week1_start)
+
+    ev = _event_source(db, min(week0_start, week1_start), buckets)
+    in_week0 = (ev.c.event_day >= w0_start) & (ev.c.event_day < w0_start + 7)
+    in_week1 = (ev.c.event_day >= w1_start) & (ev.c.event_day < w1_start + 7)
+    query = (
+        db.query(
+            Companies.company_id,
+            Companies.company_name,
+            func.count(distinct(case((in_week0, ev.c.user_id)))),
+            func.count(distinct(case((in_week1, ev.c.user_id)))),
+        )
+        .select_from(ev)
+        .join(Users, Users.user_id == ev.c.user_id)
+        .join(Companies, Companies.company_id == Users.company_id)
+        .filter(or_(in_week0, in_week1))
+    )
+    rows = filter_users(query, segment).group_by(Companies.company_id).all()
+    return (
+        {company_id: name for company_id, name, _, _ in rows},
+        {company_id: w0 for company_id, _, w0, _ in rows},
+        {company_id: w1 for company_id, _, _, w1 in rows},
+    )
+
+
+def get_company_wow_change(
+    db: Session,
+    week0_start: date,
+    week1_start: date,
+    drop_threshold: float = 0.2,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
+) -> List[Dict]:
+    buckets = sample_buckets(sample_rate)
+    partials = scatter(db, _company_wow_partial, week0_start, week1_start, segment, buckets)
+    names: Dict[str, str] = {}
+    for shard_names, _, _ in partials:
+        names.update(shard_names)
+    week0 = _sum_counts(w0 for _, w0, _ in partials)
+    week1 = _sum_counts(w1 for _, _, w1 in partials)
+
+    result = []
+    for company_id, company_name in names.items():
+        w0, w1 = week0[company_id], week1[company_id]
+        if w0 == 0:
+            continue
+        change_pct = (w1 - w0) / w0
+        if change_pct <= -drop_threshold:
+            result.append(
+                {
+                    "company_id": company_id,
+                    "company_name": company_name,
+                    "active_seats_week0": scale(w0, buckets),
+                    "active_seats_week1": scale(w1, buckets),
+                    "change_pct": change_pct,
+                }
+            )
+
+    result.sort(key=lambda x: (x["change_pct"], x["company_id"]))
+    return result
+
+
+def _cohort_retention_partial(
+    db: Session,
+    cohort_start: date,
+    cohort_end: date,
+    activity_events: Optional[Sequence[str]],
+    grain: str,
+    max_periods: int,
+    dimension: Optional[str],
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int],
+) -> Tuple[Dict[Tuple, int], Dict[Tuple, int]]:
+    grain_days = GRAIN_DAYS[grain]
+    if grain == "week":
+        cohort = _week_start_sql(Users.signup_date)
+    else:
+        cohort = func.date(Users.signup_date)
+    dim = user_dimension(dimension) if dimension else literal(None)
+
+    cohort_query = _cohort_users(
+        db.query(cohort, dim, func.count()), cohort_start, cohort_end, None, buckets
+    )
+    cohort_sizes = {
+        (c, d): n
+        for c, d, n in filter_users(cohort_query, segment).group_by(cohort, dim).all()
+    }
+    if not cohort_sizes:
+        return {}, {}
+
+    # one grouped pass over the cohort's events; SQLite sorts by the group key
+    signup_day = cast(func.julianday(Users.signup_date) - _JULIAN_EPOCH, Integer)
+    ev = _event_source(db, cohort_start, buckets)
+    period = (ev.c.event_day - signup_day) // grain_days
+    query = (
+        db.query(cohort, dim, period, func.count(distinct(ev.c.user_id)))
+        .select_from(ev)
+        .join(Users, Users.user_id == ev.c.user_id)
+        .filter(Users.signup_date >= cohort_start)
+        .filter(Users.signup_date <= cohort_end)
+        .filter(ev.c.event_day >= day_number(cohort_start))
+        .filter(ev.c.event_day >= signup_day)
+        .filter(period <= max_periods)
+    )
+    if activity_events:
+        query = query.filter(ev.c.event_name.in_(list(activity_events)))
+    else:
+        query = query.filter(ev.c.event_name != "signup")
+    rows = filter_users(query, segment).group_by(cohort, dim, period).all()
+    return cohort_sizes, {(c, d, p): active_users for c, d, p, active_users in rows}
+
+
+def get_cohort_retention(
+    db: Session,
+    cohort_start: date,
+    cohort_end: date,
+    activity_events: Optional[Sequence[str]] = None,
+    grain: str = "week",
+    max_periods: int = 12,
+    dimension: Optional[str] = None,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
+) -> List[Dict]:
+    if grain not in GRAIN_DAYS:
+        raise ValueError(f"Unknown grain {grain!r}; expected one of {sorted(GRAIN_DAYS)}")
+    if max_periods < 0:
+        raise ValueError("max_periods must be at least 0")
+    if dimension:
+        user_dimension(dimension)
+    buckets = sample_buckets(sample_rate)
+
+    partials = scatter(
+        db,
+        _cohort_retention_partial,
+        cohort_start,
+        cohort_end,
+        activity_events,
+        grain,
+        max_periods,
+        dimension,
+        segment,
+        buckets,
+    )
+    cohort_sizes = _sum_counts(sizes for sizes, _ in partials)
+    if not cohort_sizes:
+        return []
+    active = _sum_counts(shard_active for _, shard_active in partials)
+
+    result = []
+    for (c, d, p), active_users in active.items():
+        size = cohort_sizes.get((c, d), 0)
+        item = {
+            "cohort_start": c,
+            "segment": d,
+            "period": p,
+            "cohort_size": scale(size, buckets),
+            "active_users": scale(active_users, buckets),
+            "retention": active_users / size if size else 0.0,
+        }
+        if buckets is not None:
+            item["retention_ci"] = wilson_interval(active_users, size)
+        result.append(item)
+
+    result.sort(key=lambda x: (x["cohort_start"], x["segment"] or "", x["period"]))
+    return result
+
+
+def _funnel_partial(
+    db: Session,
+    steps: List[str],
+    start_date: date,
+    end_date: date,
+    window_days: int,
+    breakdown: Optional[str],
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int],
+) -> Dict[Optional[str], List[int]]:
+    dim = user_dimension(breakdown) if breakdown else literal(None)
+    window = timedelta(days=window_days)
+    range_start = datetime.combine(start_date, datetime.min.time())
+    range_end = datetime.combine(end_date, datetime.min.time())
+    # step order needs exact timestamps, which rollups don't keep
+    compacted_before = _compacted_before(db)
+    if compacted_before is not None and range_start < compacted_before:
+        raise ValueError(
+            f"Events before {compacted_before.date().isoformat()} were compacted by "
+            "app.retention; funnels need raw events, so start_date must be on or after it"
+        )
+
+    # users must enter within the range; later steps may finish inside the window
+    query = (
+        db.query(Events.user_id, Events.event_name, Events.event_time, dim)
+        .join(Users, Users.user_id == Events.user_id)
+        .filter(Events.event_name.in_(set(steps)))
+        .filter(Events.event_time >= range_start)
+        .filter(Events.event_time < range_end + window)
+    )
+    query = filter_users(_sample(query, Events.sample_bucket, buckets), segment)
+    # events sharing a timestamp are taken in step order, so steps logged
+    # together count as done in sequence (an event name repeated in `steps`
+    # sorts as its first step)
+    step_order = case(
+        {name: i for i, name in reversed(list(enumerate(steps)))}, value=Events.event_name
+    )
+    rows = _stream(query.order_by(Events.user_id, Events.event_time, step_order))
+
+    reached: Dict[Optional[str], List[int]] = defaultdict(lambda: [0] * len(steps))
+
+    # only the current user's progress is held in memory
+    current_user = None
+    current_segment = None
+    depth = 0
+    entered_at = None
+    for user_id, event_name, event_time, seg in rows:
+        if user_id != current_user:
+            for i in range(depth):
+                reached[current_segment][i] += 1
+            current_user, current_segment = user_id, seg
+            depth, entered_at = 0, None
+
+        if depth == len(steps):
+            continue
+        if depth == 0:
+            if event_name == steps[0] and event_time < range_end:
+                depth, entered_at = 1, event_time
+            continue
+        if event_time - entered_at > window:
+            continue
+        if event_name == steps[depth]:
+            depth += 1
+    for i in range(depth):
+        reached[current_segment][i] += 1
+    return dict(reached)
+
+
+def get_funnel(
+    db: Session,
+    steps: Sequence[str],
+    start_date: date,
+    end_date: date,
+    window_days: int = 14,
+    breakdown: Optional[str] = None,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
+) -> List[Dict]:
+    steps = list(steps)
+    if len(steps) < 2:
+        raise ValueError("A funnel needs at least two steps")
+    if window_days < 0:
+        raise ValueError("window_days must be at least 0")
+    if breakdown:
+        user_dimension(breakdown)
+    buckets = sample_buckets(sample_rate)
+    reached = _sum_series(
+        scatter(
+            db,
+            _funnel_partial,
+            steps,
+            start_date,
+            end_date,
+            window_days,
+            breakdown,
+            segment,
+            buckets,
+        )
+    )
+
+    result = []
+    for seg in sorted(reached, key=lambda x: x or ""):
+        counts = reached[seg]
+        for i, event_name in enumerate(steps):
+            prev = counts[i - 1] if i else counts[0]
+            item = {
+                "segment": seg,
+                "step": i + 1,
+                "event_name": event_name,
+                "users": scale(counts[i], buckets),
+                "conversion_from_start": counts[i] / counts[0] if counts[0] else 0.0,
+                "conversion_from_previous": counts[i] / prev if prev else 0.0,
+            }
+            if buckets is not None:
+                item["conversion_from_start_ci"] = wilson_interval(counts[i], counts[0])
+                item["conversion_from_previous_ci"] = wilson_interval(counts[i], prev)
+            result.append(item)
+    return result
+
+
+def _anomalies_partial(
+    db: Session,
+    end_date: date,
+    grain_days: int,
+    n_periods: int,
+    dimensions: List[str],
+    measure: str,
+    segment: Optional[SegmentFilter],
+    buckets: Optional[int],
+) -> Dict[Tuple[str, str, str], List[int]]:
+    range_start = day_number(end_date) - grain_days * n_periods
+    ev = _event_source(db, day_from_number(range_start), buckets)
+    period = (ev.c.event_day - range_start) // grain_days
+
+    # every user sits in exactly one (country, plan, channel) cell, so
+    # distinct-user counts per cell add up exactly when rolled up below
+    cell_columns = [USER_DIMENSIONS[name] for name in dimensions]
+    if measure == "users":
+        value = func.count(distinct(ev.c.user_id))
+    else:
+        value = func.sum(ev.c.event_count)
+    query = (
+        db.query(*cell_columns, ev.c.event_name, period, value)
+        .join(Users, Users.user_id == ev.c.user_id)
+        .filter(ev.c.event_day >= range_start)
+        .filter(ev.c.event_day < day_number(end_date))
+    )
+    rows = filter_users(query, segment).group_by(*cell_columns, ev.c.event_name, period).all()
+
+    series: Dict[Tuple[str, str, str], List[int]] = defaultdict(lambda: [0] * n_periods)
+    for row in rows:
+        cell, event_name, p, v = row[:-3], row[-3], row[-2], row[-1]
+        for name, dim_value in zip(dimensions, cell):
+            series[(name, dim_value, event_name)][p] += v
+    return dict(series)
+
+
+def get_anomalies(
+    db: Session,
+    end_date: date,
+    grain: str = "week",
+    baseline_periods: int = 4,
+    dimensions: Optional[Sequence[str]] = None,
+    measure: str = "users",
+    top_k: int = 10,
+    min_volume: int = 5,
+    segment: Optional[SegmentFilter] = None,
+    sample_rate: Optional[float] = None,
+) -> List[Dict]:
+    grain_days = GRAIN_DAYS.get(grain)
+    if grain_days is None:
+        raise ValueError(f"Unknown grain {grain!r}; expected one of {sorted(GRAIN_DAYS)}")
+    if measure not in ("users", "events"):
+        raise ValueError(f"Unknown measure {measure!r}; expected 'users' or 'events'")
+    if baseline_periods < 2:
+        # one baseline period has no spread to score against
+        raise ValueError("baseline_periods must be at least 2")
+    if top_k < 1:
+        raise ValueError("top_k must be at least 1")
+    if min_volume < 0:
+        raise ValueError("min_volume must be at least 0")
+    dimensions = list(dimensions or USER_DIMENSIONS)
+    for name in dimensions:
+        user_dimension(name)
+    buckets = sample_buckets(sample_rate)
+    # scores use the sampled counts, whose noise the Poisson floor models;
+    # volumes are reported scaled to all users
+    factor = 1.0 if buckets is None else SAMPLE_BUCKETS / buckets
+
+    series = _sum_series(
+        scatter(
+            db,
+            _anomalies_partial,
+            end_date,
+            grain_days,
+            baseline_periods + 1,
+            dimensions,
+            measure,
+            segment,
+            buckets,
+        )
+    )
+
+    result = []
+    for (name, dim_value, event_name), values in series.items():
+        baseline, current = values[:-1], values[-1]
+        mean = sum(baseline) / len(baseline) if baseline else 0.0
+        if max(mean, current) * factor < min_volume:
+            continue
+        std = sqrt(sum((v - mean) ** 2 for v in baseline) / len(baseline)) if baseline else 0.0
+        # Poisson floor keeps flat or tiny baselines from producing infinite scores
+        z_score = (current - mean) / max(std, sqrt(max(mean, 1.0)))
+        result.append(
+            {
+                "dimension": name,
+                "value": dim_value,
+                "event_name": event_name,
+                "period_start": (end_date - timedelta(days=grain_days)).isoformat(),
+                "current": scale(current, buckets),
+                "baseline_mean": mean * factor,
+                "baseline_std": std * factor,
+                "z_score": z_score,
+                "change_pct": (current - mean) / mean if mean else None,
+            }
+        )
+
+    result.sort(key=lambda x: (-abs(x["z_score"]), x["dimension"], x["value"] or "", x["event_name"]))
+    return result[:top_k]
+
+
 if __name__ == "__main__":
     db = get_db()
     today = date.today()
@@ -321,4 +1068,27 @@ if __name__ == "__main__":
     w1 = w0 + timedelta(days=7)
     wow = get_country_wow_change(db, w0, w1)
     print("country_wow_change", wow)
+
+    waa = get_weekly_active_accounts(db, today - timedelta(days=28), today)
+    print("weekly_active_accounts", waa)
+
+    seats = get_company_active_seats(db, today - timedelta(days=7), today, limit=5)
+    print("company_active_seats sample", seats)
+
+    cwow = get_company_wow_change(db, w0, w1)
+    print("company_wow_change", cwow[:5])
+
+    ret = get_cohort_retention(db, today - timedelta(days=56), today, max_periods=4)
+    print("cohort_retention sample", ret[:5])
+
+    funnel = get_funnel(
+        db,
+        ["signup", "view_dashboard", "invite_teammate", "upgrade_plan"],
+        today - timedelta(days=60),
+        today,
+    )
+    print("funnel", funnel)
+
+    anomalies = get_anomalies(db, today, top_k=5)
+    print("anomalies", anomalies)
     db.close()
\ No newline at end of file
@@ -0,0 +1,41 @@
+import os
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+# Day and week buckets are cut in this timezone; event_time is stored as
+# naive UTC. Changing it needs `python -m app.init_db --rebucket`.
+REPORTING_TIMEZONE = os.environ.get("ANALYTICS_TIMEZONE", "UTC")
+
+EPOCH = date(1970, 1, 1)
+
+_tz = ZoneInfo(REPORTING_TIMEZONE)
+_is_utc = REPORTING_TIMEZONE in ("UTC", "Etc/UTC")
+
+
+def day_number(d: date) -> int:
+    return (d - EPOCH).days
+
+
+def day_from_number(n: int) -> date:
+    return EPOCH + timedelta(days=n)
+
+
+def week_number(day: int) -> int:
+    # day number of that week's Monday (1970-01-01 was a Thursday)
+    return day - (day + 3) % 7
+
+
+def local_day(event_time: datetime) -> int:
+    if not _is_utc:
+        event_time = event_time.replace(tzinfo=timezone.utc).astimezone(_tz)
+    return day_number(event_time.date())
+
+
+def event_day_default(context) -> int:
+    event_time = context.get_current_parameters().get("event_time")
+    return None if event_time is None else local_day(event_time)
+
+
+def event_week_default(context) -> int:
+    event_time = context.get_current_parameters().get("event_time")
+    return None if event_time is None else week_number(local_day(event_time))
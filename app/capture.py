@@ -0,0 +1,71 @@
+import os
+import threading
+from typing import Any, Dict, Optional
+
+from .serialization import dumps
+
+
+class Capture:
+    """Appends one JSON line per metric request, for replay with bench.replay.
+
+    Each line holds the wall-clock start time, the transport ("http" or
+    "mcp"), the tool name, its arguments as received, the duration in
+    milliseconds and whether it succeeded. HTTP arguments are the raw query
+    string values; MCP arguments are the tool arguments. A capture with no
+    path records nothing.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self.recorded = 0
+
+    @classmethod
+    def from_env(cls) -> "Capture":
+        return cls(os.environ.get("ANALYTICS_CAPTURE") or None)
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def record(
+        self,
+        transport: str,
+        tool: str,
+        arguments: Dict[str, Any],
+        started: float,
+        elapsed: float,
+        ok: bool = True,
+        status: Optional[int] = None,
+    ) -> None:
+        if self.path is None:
+            return
+        line = {
+            "ts": round(started, 6),
+            "transport": transport,
+            "tool": tool,
+            "arguments": arguments,
+            "duration_ms": round(elapsed * 1000, 3),
+            "ok": ok,
+        }
+        if status is not None:
+            line["status"] = status
+        data = dumps(line) + b"\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            # one write per line, flushed, so concurrent processes appending
+            # to the same file don't interleave and a crash loses nothing
+            self._file.write(data)
+            self._file.flush()
+            self.recorded += 1
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"path": self.path, "recorded": self.recorded}
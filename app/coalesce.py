@@ -0,0 +1,75 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from datetime import date
+from typing import Any, Callable, Dict, Hashable, Mapping, Sequence, Tuple
+
+
+def freeze(value: Any) -> Hashable:
+    if isinstance(value, Mapping):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def make_key(name: str, args: Sequence[Any] = (), kwargs: Mapping[str, Any] = None) -> Tuple:
+    return (name, freeze(list(args)), freeze(kwargs or {}))
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one in-flight computation.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _claim(self, key: Hashable) -> Tuple[Future, bool]:
+        with self._lock:
+            fut = self._calls.get(key)
+            if fut is not None:
+                self.coalesced += 1
+                return fut, False
+            fut = Future()
+            self._calls[key] = fut
+            self.leaders += 1
+            return fut, True
+
+    def _run(self, key: Hashable, fut: Future, fn: Callable[[], Any]) -> None:
+        try:
+            result = fn()
+        except BaseException as exc:
+            with self._lock:
+                self._calls.pop(key, None)
+            fut.set_exception(exc)
+        else:
+            with self._lock:
+                self._calls.pop(key, None)
+            fut.set_result(result)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        fut, leader = self._claim(key)
+        if leader:
+            self._run(key, fut, fn)
+        return fut.result()
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        # fn is blocking; the leader runs it in the default executor
+        fut, leader = self._claim(key)
+        if leader:
+            asyncio.get_running_loop().run_in_executor(None, self._run, key, fut, fn)
+        # shield so a cancelled waiter can't cancel the shared future
+        return await asyncio.shield(asyncio.wrap_future(fut))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            in_flight = len(self._calls)
+        return {
+            "in_flight": in_flight,
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
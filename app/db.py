@@ -1,13 +1,51 @@
+import hashlib
+import os
+from functools import lru_cache
+
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 DATABASE_URL = "sqlite:///./analytics.db"
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False},  # needed for SQLite + FastAPI
-)
+# ANALYTICS_SHARDS > 1 spreads users, with their events, across that many
+# SQLite files by user_id hash: shard 0 is analytics.db, shard i is
+# analytics-shard-i.db. Companies are copied to every shard. Change the
+# count with `python -m app.shards rebalance --to N`.
+SHARD_COUNT = int(os.environ.get("ANALYTICS_SHARDS", "1"))
+
+
+def shard_url(index: int, directory: str = ".") -> str:
+    if index == 0:
+        return DATABASE_URL if directory == "." else f"sqlite:///{directory}/analytics.db"
+    return f"sqlite:///{directory}/analytics-shard-{index}.db"
+
+
+@lru_cache(maxsize=None)
+def shard_engine(index: int):
+    return create_engine(
+        shard_url(index),
+        connect_args={"check_same_thread": False},  # needed for SQLite + FastAPI
+    )
+
+
+def shard_for(user_id: str, count: int = SHARD_COUNT) -> int:
+    # jump consistent hash (Lamping & Veach): going from n to m shards only
+    # moves the users whose shard index is at least min(n, m)
+    key = int.from_bytes(hashlib.blake2b(user_id.encode(), digest_size=8).digest(), "big")
+    bucket, j = -1, 0
+    while j < count:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+engines = [shard_engine(i) for i in range(SHARD_COUNT)]
+engine = engines[0]
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+shard_sessions = [
+    sessionmaker(autocommit=False, autoflush=False, bind=shard) for shard in engines
+]
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
@@ -0,0 +1,77 @@
+from dataclasses import dataclass, fields
+from typing import Any, List, Mapping, Optional
+
+from sqlalchemy import select
+
+from .models import Users, Companies, Events
+
+
+@dataclass(frozen=True)
+class SegmentFilter:
+    country: Optional[str] = None
+    plan_tier: Optional[str] = None
+    acquisition_channel: Optional[str] = None
+    company_id: Optional[str] = None
+    min_employees: Optional[int] = None
+    max_employees: Optional[int] = None
+
+    @classmethod
+    def from_args(cls, args: Mapping[str, Any]) -> Optional["SegmentFilter"]:
+        values = {
+            f.name: args[f.name]
+            for f in fields(cls)
+            if args.get(f.name) is not None
+        }
+        for key in ("min_employees", "max_employees"):
+            if key in values:
+                values[key] = int(values[key])
+        return cls(**values) if values else None
+
+    def user_predicates(self) -> List:
+        predicates = []
+        if self.country is not None:
+            predicates.append(Users.country == self.country)
+        if self.plan_tier is not None:
+            predicates.append(Users.plan_tier == self.plan_tier)
+        if self.acquisition_channel is not None:
+            predicates.append(Users.acquisition_channel == self.acquisition_channel)
+        if self.company_id is not None:
+            predicates.append(Users.company_id == self.company_id)
+        if self.min_employees is not None or self.max_employees is not None:
+            companies = select(Companies.company_id)
+            if self.min_employees is not None:
+                companies = companies.where(Companies.employee_count >= self.min_employees)
+            if self.max_employees is not None:
+                companies = companies.where(Companies.employee_count <= self.max_employees)
+            predicates.append(Users.company_id.in_(companies))
+        return predicates
+
+
+def filter_users(query, segment: Optional[SegmentFilter]):
+    if segment is None:
+        return query
+    return query.filter(*segment.user_predicates())
+
+
+def filter_events(query, segment: Optional[SegmentFilter], user_id=Events.user_id):
+    if segment is None:
+        return query
+    return query.join(Users, Users.user_id == user_id).filter(
+        *segment.user_predicates()
+    )
+
+
+USER_DIMENSIONS = {
+    "country": Users.country,
+    "plan_tier": Users.plan_tier,
+    "acquisition_channel": Users.acquisition_channel,
+}
+
+
+def user_dimension(name: str):
+    column = USER_DIMENSIONS.get(name)
+    if column is None:
+        raise ValueError(
+            f"Unknown dimension {name!r}; expected one of {sorted(USER_DIMENSIONS)}"
+        )
+    return column
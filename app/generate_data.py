@@ -2,15 +2,15 @@ import uuid
 import random
 from datetime import datetime, timedelta, date
 
-from sqlalchemy.orm import Session
-
-from .db import SessionLocal
 from .models import Users, Companies, Events
+from .shards import insert_rows
 
 
 COUNTRIES = ["US", "UK", "DE", "IN", "CA"]
 PLANS = ["free", "pro", "enterprise"]
 CHANNELS = ["organic", "paid", "referral"]
+FORMATS = ["csv", "pdf", "xlsx"]
+PLATFORMS = ["web", "ios", "android"]
 EVENTS = [
     "signup",
     "login",
@@ -26,23 +26,31 @@ def random_date(start_date: date, end_date: date):
     return start_date + timedelta(days=random.randint(0, delta))
 
 
-def main():
-    db: Session = SessionLocal()
+def event_metadata(rng: random.Random, name: str) -> dict:
+    metadata = {"platform": rng.choice(PLATFORMS)}
+    if name == "export_report":
+        metadata["format"] = rng.choice(FORMATS)
+    return metadata
+
 
+def main():
     random.seed(42)
+    # separate stream so metadata doesn't shift the seeded users/events
+    meta_rng = random.Random(7)
 
     companies = []
     for _ in range(50):
         cid = str(uuid.uuid4())
-        company = Companies(
-            company_id=cid,
-            company_name=f"Company_{cid[:8]}",
-            employee_count=random.randint(3, 500),
+        companies.append(
+            {
+                "company_id": cid,
+                "company_name": f"Company_{cid[:8]}",
+                "employee_count": random.randint(3, 500),
+            }
         )
-        companies.append(company)
-        db.add(company)
 
-    db.commit()
+    # companies go to every shard; users and events to their user's shard
+    insert_rows(Companies.__table__, companies)
 
     users = []
     start = date.today() - timedelta(days=120)
@@ -58,39 +66,39 @@ def main():
             k=1,
         )[0]
 
-        user = Users(
-            user_id=uid,
-            company_id=company.company_id,
-            country=random.choice(COUNTRIES),
-            plan_tier=plan,
-            signup_date=signup,
-            acquisition_channel=random.choice(CHANNELS),
+        users.append(
+            {
+                "user_id": uid,
+                "company_id": company["company_id"],
+                "country": random.choice(COUNTRIES),
+                "plan_tier": plan,
+                "signup_date": signup,
+                "acquisition_channel": random.choice(CHANNELS),
+            }
         )
-        users.append(user)
-        db.add(user)
 
-    db.commit()
+    insert_rows(Users.__table__, users)
 
     events = []
 
     for u in users:
         # signup event
         events.append(
-            Events(
-                event_id=str(uuid.uuid4()),
-                user_id=u.user_id,
-                event_name="signup",
-                event_time=datetime.combine(u.signup_date, datetime.min.time())
+            {
+                "event_id": str(uuid.uuid4()),
+                "user_id": u["user_id"],
+                "event_name": "signup",
+                "event_time": datetime.combine(u["signup_date"], datetime.min.time())
                 + timedelta(hours=random.randint(0, 23)),
-                event_metadata={},
-            )
+                "metadata": {},
+            }
         )
 
         # simulate activity days
         days_active = random.randint(0, 40)
 
         for d in range(days_active):
-            day = u.signup_date + timedelta(days=d)
+            day = u["signup_date"] + timedelta(days=d)
             if day > date.today():
                 break
 
@@ -104,20 +112,17 @@ def main():
                 )[0]
 
                 events.append(
-                    Events(
-                        event_id=str(uuid.uuid4()),
-                        user_id=u.user_id,
-                        event_name=name,
-                        event_time=datetime.combine(day, datetime.min.time())
+                    {
+                        "event_id": str(uuid.uuid4()),
+                        "user_id": u["user_id"],
+                        "event_name": name,
+                        "event_time": datetime.combine(day, datetime.min.time())
                         + timedelta(hours=random.randint(8, 22)),
-                        event_metadata={},
-                    )
+                        "metadata": event_metadata(meta_rng, name),
+                    }
                 )
 
-    db.bulk_save_objects(events)
-    db.commit()
-
-    db.close()
+    insert_rows(Events.__table__, events)
 
 
 if __name__ == "__main__":
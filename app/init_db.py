@@ -1,10 +1,134 @@
-from .db import Base, engine
+import argparse
+import logging
+from datetime import datetime
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from .buckets import local_day, week_number
+from .db import Base, engines
+from .sampling import sample_bucket
 from . import models  # noqa: F401
+from .models import EVENT_DAY_VERSION_TRIGGERS
+
+logger = logging.getLogger(__name__)
+
+# replaced by indexes under new names, so create(checkfirst=True) builds those
+SUPERSEDED_INDEXES = ["ix_events_meta_format", "ix_events_meta_platform"]
+
+
+def _add_missing_columns(conn):
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # computed columns are added as VIRTUAL, which ALTER TABLE allows
+            ddl = CreateColumn(column).compile(dialect=conn.dialect)
+            conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+
+
+def _enable_incremental_vacuum(engine):
+    # lets app.retention hand freed pages back without a full VACUUM
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2:
+            return
+        conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        # an existing file only switches modes after one full VACUUM
+        conn.exec_driver_sql("VACUUM")
 
 
-def init_db():
+def _backfill(conn, table, time_column, day_column, week_column, rebucket, batch_size):
+    pending = "" if rebucket else f" AND {day_column} IS NULL"
+    last_rowid = 0
+    while True:
+        rows = conn.exec_driver_sql(
+            f"SELECT rowid, {time_column} FROM {table} "
+            f"WHERE rowid > ? AND {time_column} IS NOT NULL{pending} "
+            "ORDER BY rowid LIMIT ?",
+            (last_rowid, batch_size),
+        ).fetchall()
+        if not rows:
+            return
+        updates = []
+        for rowid, value in rows:
+            day = local_day(datetime.fromisoformat(value))
+            updates.append((day, week_number(day), rowid))
+        conn.exec_driver_sql(
+            f"UPDATE {table} SET {day_column} = ?, {week_column} = ? WHERE rowid = ?",
+            updates,
+        )
+        last_rowid = rows[-1][0]
+
+
+def backfill_event_buckets(conn, rebucket: bool = False, batch_size: int = 5000):
+    # event_day/event_week for rows written before the columns existed, or
+    # for every raw event after ANALYTICS_TIMEZONE changed
+    _backfill(conn, "events", "event_time", "event_day", "event_week", rebucket, batch_size)
+    # A rollup only knows its UTC day, so recomputing would file all of it
+    # under one local day; compacted history keeps the buckets it was cut in.
+    if rebucket and conn.exec_driver_sql("SELECT 1 FROM event_rollups LIMIT 1").first():
+        logger.warning(
+            "event_rollups keep their old day/week buckets; compacted history can't be re-cut"
+        )
+    _backfill(conn, "event_rollups", "event_day", "bucket_day", "bucket_week", False, batch_size)
+
+
+def backfill_sample_buckets(conn, batch_size: int = 5000):
+    # sample_bucket for rows written before the column existed
+    for table in ("users", "events", "event_rollups"):
+        last_rowid = 0
+        while True:
+            rows = conn.exec_driver_sql(
+                f"SELECT rowid, user_id FROM {table} "
+                "WHERE rowid > ? AND user_id IS NOT NULL AND sample_bucket IS NULL "
+                "ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size),
+            ).fetchall()
+            if not rows:
+                break
+            conn.exec_driver_sql(
+                f"UPDATE {table} SET sample_bucket = ? WHERE rowid = ?",
+                [(sample_bucket(user_id), rowid) for rowid, user_id in rows],
+            )
+            last_rowid = rows[-1][0]
+
+
+def init_engine(engine, rebucket: bool = False):
+    _enable_incremental_vacuum(engine)
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        _add_missing_columns(conn)
+        for name in SUPERSEDED_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+        backfill_event_buckets(conn, rebucket)
+        backfill_sample_buckets(conn)
+        # days that predate the triggers start out changed at version 1
+        conn.exec_driver_sql(
+            "INSERT OR IGNORE INTO event_day_versions (event_day, version) "
+            "SELECT DISTINCT date(event_day * 86400, 'unixepoch'), 1 FROM events "
+            "WHERE event_day IS NOT NULL"
+        )
+        for name, body in EVENT_DAY_VERSION_TRIGGERS.items():
+            conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+            conn.exec_driver_sql(f"CREATE TRIGGER {name} {body}")
+
+
+def init_db(rebucket: bool = False):
+    for engine in engines:
+        init_engine(engine, rebucket)
 
 
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Create or migrate the analytics database")
+    parser.add_argument(
+        "--rebucket",
+        action="store_true",
+        help="recompute event_day/event_week for every raw event (after changing ANALYTICS_TIMEZONE)",
+    )
+    logging.basicConfig(level=logging.INFO)
+    init_db(parser.parse_args().rebucket)
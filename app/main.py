@@ -1,107 +1,283 @@
-from datetime import datetime, date, timedelta
-from typing import List
+import inspect
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
 
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
 
-from .db import SessionLocal
-from . import analytics
-from .schemas import (
-    ActivationRateResponse,
-    WAUByPlanResponse,
-    FeatureTimeseriesResponse,
-    ConversionByChannelResponse,
-    FeatureUsageBySegmentResponse,
-    CountryWoWChangeResponse,
+from .capture import Capture
+from .coalesce import SingleFlight, make_key
+from .precompute import Precomputer
+from .registry import METRICS, Metric, Param
+from .filters import SegmentFilter
+from .sampling import sample_buckets
+from .serialization import FastJSONResponse
+from .snapshots import Snapshot, SnapshotManager, snapshot_of
+from .tenants import TenantBusy, TenantRouter, query_slot, tenant_of
+from .watermark import Version, compute_since, decode_watermark
+
+
+# identical concurrent metric requests share one computation
+_inflight = SingleFlight()
+# ANALYTICS_SNAPSHOT_INTERVAL > 0 serves reads from periodic backup copies
+_snapshots = SnapshotManager.from_env()
+_precomputed = Precomputer.from_env(
+    session_factory=_snapshots.session, watch_commits=not _snapshots.enabled
 )
+_snapshots.subscribe(_precomputed.trigger)
+# ANALYTICS_CAPTURE=path records each metric request for bench.replay
+_capture = Capture.from_env()
+# ANALYTICS_TENANT_DIR=path serves ?tenant=<name> from <path>/<name>/
+_tenants = TenantRouter.from_env()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _snapshots.start()
+    _precomputed.start()
+    _tenants.start()
+    yield
+    _tenants.stop()
+    _precomputed.stop()
+    _snapshots.stop()
+    _capture.close()
+
 
+app = FastAPI(title="Feature Analytics Service", lifespan=lifespan)
 
-app = FastAPI(title="Feature Analytics Service")
 
+async def capture_metrics(request: Request, call_next):
+    if not request.url.path.startswith("/metrics/"):
+        return await call_next(request)
+    tool = request.url.path[len("/metrics/"):]
+    arguments = dict(request.query_params)
+    started = time.time()
+    began = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except Exception:
+        _capture.record(
+            "http", tool, arguments, started, time.perf_counter() - began, ok=False, status=500
+        )
+        raise
+    _capture.record(
+        "http",
+        tool,
+        arguments,
+        started,
+        time.perf_counter() - began,
+        ok=response.status_code < 400,
+        status=response.status_code,
+    )
+    return response
+
+
+# registered only when capturing, so normal serving skips the middleware
+if _capture.enabled:
+    app.middleware("http")(capture_metrics)
 
-def get_db():
-    db = SessionLocal()
+
+def get_db(tenant: Optional[str] = None):
+    # without a tenant, the server's own database (or its snapshot)
+    if tenant is None:
+        db = _snapshots.session()
+    else:
+        try:
+            db = _tenants.session(tenant)
+        except ValueError as exc:
+            raise HTTPException(status_code=404, detail=str(exc))
     try:
         yield db
     finally:
         db.close()
 
 
+def get_segment_filter(
+    country: Optional[str] = None,
+    plan_tier: Optional[str] = None,
+    acquisition_channel: Optional[str] = None,
+    company_id: Optional[str] = None,
+    min_employees: Optional[int] = None,
+    max_employees: Optional[int] = None,
+) -> Optional[SegmentFilter]:
+    return SegmentFilter.from_args(
+        {
+            "country": country,
+            "plan_tier": plan_tier,
+            "acquisition_channel": acquisition_channel,
+            "company_id": company_id,
+            "min_employees": min_employees,
+            "max_employees": max_employees,
+        }
+    )
+
+
+def get_since(since: Optional[str] = None) -> Optional[Version]:
+    # opaque watermark from a previous response -> change version
+    if since is None:
+        return None
+    try:
+        return decode_watermark(since)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+
+def get_sample_rate(sample_rate: Optional[float] = None) -> Optional[float]:
+    try:
+        sample_buckets(sample_rate)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return sample_rate
+
+
+def _snapshot_headers(snapshot: Optional[Snapshot]) -> Optional[Dict[str, str]]:
+    if snapshot is None:
+        return None
+    freshness = snapshot.freshness()
+    return {
+        "X-Snapshot-At": freshness["taken_at"],
+        "X-Snapshot-Age": str(freshness["age_seconds"]),
+    }
+
+
+def _precomputed_headers(entry) -> Dict[str, str]:
+    freshness = entry.freshness()
+    return {
+        "X-Precomputed-At": freshness["computed_at"],
+        "X-Precomputed-Window": freshness["window"],
+        **(_snapshot_headers(entry.snapshot) or {}),
+    }
+
+
+def _run_metric(name: str, fn, db: Session, *args, **kwargs):
+    # precomputed answers only cover the server's own database
+    tenant = tenant_of(db)
+    if tenant is None:
+        entry = _precomputed.lookup(make_key(name, args, kwargs))
+        if entry is not None:
+            return entry.value, _precomputed_headers(entry)
+
+    # the snapshot travels with the value: a coalesced caller was served
+    # whatever the leader's session read, not its own session's snapshot
+    def compute():
+        with query_slot(db):
+            return fn(db, *args, **kwargs), snapshot_of(db)
+
+    value, snapshot = _inflight.do(make_key(name, args, {**kwargs, "tenant": tenant}), compute)
+    return value, _snapshot_headers(snapshot)
+
+
+def _compute_since(db: Session, name: str, fn, args, kwargs, since_version):
+    with query_slot(db):
+        return compute_since(db, name, fn, args, kwargs, since_version), snapshot_of(db)
+
+
+def _run_list_metric(
+    name: str, fn, db: Session, *args, since_version: Optional[Version] = None, **kwargs
+):
+    # {"items", "watermark"[, "changed_buckets"]} for list-valued metrics
+    tenant = tenant_of(db)
+    if since_version is None and tenant is None:
+        entry = _precomputed.lookup(make_key(name, args, kwargs))
+        if entry is not None:
+            payload = {"items": entry.value, "watermark": entry.watermark}
+            return payload, _precomputed_headers(entry)
+    payload, snapshot = _inflight.do(
+        make_key(name, args, {**kwargs, "since_version": since_version, "tenant": tenant}),
+        lambda: _compute_since(db, name, fn, args, kwargs, since_version),
+    )
+    return payload, _snapshot_headers(snapshot)
+
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
 
-@app.get("/metrics/activation_rate", response_model=ActivationRateResponse)
-def activation_rate(
-    cohort_start: str,
-    cohort_end: str,
-    db: Session = Depends(get_db),
-):
-    cs = date.fromisoformat(cohort_start)
-    ce = date.fromisoformat(cohort_end)
-    rate = analytics.get_activation_rate(db, cs, ce)
-    return {"activation_rate_7d": rate}
+@app.get("/stats")
+def stats():
+    return {
+        "coalescing": _inflight.stats(),
+        "precompute": _precomputed.stats(),
+        "snapshots": _snapshots.stats(),
+        "capture": _capture.stats(),
+        "tenants": _tenants.stats(),
+    }
 
 
-@app.get("/metrics/wau_by_plan", response_model=WAUByPlanResponse)
-def wau_by_plan(
-    start_date: str,
-    end_date: str,
-    db: Session = Depends(get_db),
-):
-    sd = date.fromisoformat(start_date)
-    ed = date.fromisoformat(end_date)
-    items = analytics.get_wau_by_plan(db, sd, ed)
-    return {"items": items}
-
-
-@app.get("/metrics/feature_timeseries", response_model=FeatureTimeseriesResponse)
-def feature_timeseries(
-    event_name: str,
-    start_date: str,
-    end_date: str,
-    db: Session = Depends(get_db),
-):
-    sd = date.fromisoformat(start_date)
-    ed = date.fromisoformat(end_date)
-    items = analytics.get_feature_timeseries(db, event_name, sd, ed)
-    return {"items": items}
+def _query_parameter(param: Param) -> inspect.Parameter:
+    annotation: Any = {"integer": int, "number": float}.get(param.kind, str)
+    if param.required:
+        default = inspect.Parameter.empty
+    else:
+        default = param.default
+        if default is None:
+            annotation = Optional[annotation]
+    return inspect.Parameter(
+        param.name, inspect.Parameter.KEYWORD_ONLY, default=default, annotation=annotation
+    )
 
 
-@app.get("/metrics/conversion_by_channel", response_model=ConversionByChannelResponse)
-def conversion_by_channel(
-    cohort_start: str,
-    cohort_end: str,
-    db: Session = Depends(get_db),
-):
-    cs = date.fromisoformat(cohort_start)
-    ce = date.fromisoformat(cohort_end)
-    items = analytics.get_conversion_by_channel(db, cs, ce)
-    return {"items": items}
-
-
-@app.get("/metrics/feature_usage_by_segment", response_model=FeatureUsageBySegmentResponse)
-def feature_usage_by_segment(
-    plan_tier: str,
-    start_date: str,
-    end_date: str,
-    db: Session = Depends(get_db),
-):
-    sd = date.fromisoformat(start_date)
-    ed = date.fromisoformat(end_date)
-    items = analytics.get_feature_usage_by_segment(db, plan_tier, sd, ed)
-    return {"items": items}
-
-
-@app.get("/metrics/country_wow_change", response_model=CountryWoWChangeResponse)
-def country_wow_change(
-    week0_start: str,
-    week1_start: str,
-    drop_threshold: float = 0.2,
-    db: Session = Depends(get_db),
-):
-    w0 = date.fromisoformat(week0_start)
-    w1 = date.fromisoformat(week1_start)
-    items = analytics.get_country_wow_change(db, w0, w1, drop_threshold=drop_threshold)
-    return {"items": items}
\ No newline at end of file
+def _metric_endpoint(metric: Metric):
+    # GET /metrics/<name>: the metric's params as query parameters (lists
+    # comma-separated, metadata_filter as key:value pairs), plus segment
+    # filters, sample_rate and, for list-valued metrics, since.
+    def endpoint(**values):
+        db = values.pop("db")
+        segment = values.pop("segment")
+        sample_rate = values.pop("sample_rate")
+        since_version = values.pop("since_version", None)
+        try:
+            fn, args, kwargs = metric.bind(metric.from_query(values), segment, sample_rate)
+            if metric.list_valued:
+                payload, headers = _run_list_metric(
+                    metric.name, fn, db, *args, since_version=since_version, **kwargs
+                )
+            else:
+                value, headers = _run_metric(metric.name, fn, db, *args, **kwargs)
+                payload = metric.payload(value)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+        except TenantBusy as exc:
+            raise HTTPException(status_code=429, detail=str(exc))
+        return FastJSONResponse(payload, headers=headers)
+
+    keyword = inspect.Parameter.KEYWORD_ONLY
+    dependencies = [
+        inspect.Parameter(
+            "segment",
+            keyword,
+            default=Depends(get_segment_filter),
+            annotation=Optional[SegmentFilter],
+        ),
+        inspect.Parameter(
+            "sample_rate", keyword, default=Depends(get_sample_rate), annotation=Optional[float]
+        ),
+    ]
+    if metric.list_valued:
+        dependencies.append(
+            inspect.Parameter(
+                "since_version", keyword, default=Depends(get_since), annotation=Optional[Version]
+            )
+        )
+    dependencies.append(
+        inspect.Parameter("db", keyword, default=Depends(get_db), annotation=Session)
+    )
+    endpoint.__signature__ = inspect.Signature(
+        [_query_parameter(param) for param in metric.params] + dependencies
+    )
+    return endpoint
+
+
+for _metric in METRICS.values():
+    app.add_api_route(
+        f"/metrics/{_metric.name}",
+        _metric_endpoint(_metric),
+        methods=["GET"],
+        response_model=_metric.response_model,
+        # e.g. *_ci without sample_rate, changed_buckets without since
+        response_model_exclude_unset=True,
+        name=_metric.name,
+        description=_metric.summary,
+    )
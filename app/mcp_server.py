@@ -1,171 +1,267 @@
+import argparse
 import asyncio
-import json
-from datetime import date
-from typing import Any
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Optional
 
 from mcp.server import Server
 from mcp.server.stdio import stdio_server
+from mcp.server.streamable_http_manager import StreamableHTTPSessionManager
 import mcp.types as types
+from starlette.applications import Starlette
+from starlette.routing import Route
+import uvicorn
 
-from .db import SessionLocal
-from .analytics import (
-    get_activation_rate,
-    get_wau_by_plan,
-    get_feature_timeseries,
-    get_conversion_by_channel,
-    get_feature_usage_by_segment,
-    get_country_wow_change,
-)
+from .capture import Capture
+from .coalesce import SingleFlight, make_key
+from .precompute import Precomputer
+from .registry import METRICS
+from .sampling import sample_buckets
+from .serialization import dumps_text
+from .snapshots import SnapshotManager, snapshot_of
+from .tenants import TenantBusy, TenantRouter, query_slot
+from .watermark import compute_since, decode_watermark
 
 
 server = Server("analytics-mcp")
 
+# identical concurrent tool calls share one computation
+_inflight = SingleFlight()
+# ANALYTICS_SNAPSHOT_INTERVAL > 0 serves reads from periodic backup copies
+_snapshots = SnapshotManager.from_env()
+_precomputed = Precomputer.from_env(
+    session_factory=_snapshots.session, watch_commits=not _snapshots.enabled
+)
+_snapshots.subscribe(_precomputed.trigger)
+# ANALYTICS_CAPTURE=path (or --capture) records each tool call for bench.replay
+_capture = Capture.from_env()
+# ANALYTICS_TENANT_DIR=path serves {"tenant": name} from <path>/<name>/
+_tenants = TenantRouter.from_env()
 
-def get_db():
-    return SessionLocal()
+def get_db(tenant: Optional[str] = None):
+    # without a tenant, the server's own database (or its snapshot)
+    if tenant is None:
+        return _snapshots.session()
+    return _tenants.session(tenant)
 
 
 @server.list_tools()
 async def handle_list_tools() -> list[types.Tool]:
     return [
-        types.Tool(
-            name="activation_rate",
-            description="Compute 7-day activation rate for a signup cohort.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "cohort_start": {"type": "string", "format": "date"},
-                    "cohort_end": {"type": "string", "format": "date"},
-                },
-                "required": ["cohort_start", "cohort_end"],
-            },
-        ),
-        types.Tool(
-            name="wau_by_plan",
-            description="Get weekly active users by plan tier over a date range.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "start_date": {"type": "string", "format": "date"},
-                    "end_date": {"type": "string", "format": "date"},
-                },
-                "required": ["start_date", "end_date"],
-            },
-        ),
-        types.Tool(
-            name="feature_timeseries",
-            description="Get daily counts for a feature event over a date range.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "event_name": {"type": "string"},
-                    "start_date": {"type": "string", "format": "date"},
-                    "end_date": {"type": "string", "format": "date"},
-                },
-                "required": ["event_name", "start_date", "end_date"],
-            },
-        ),
-        types.Tool(
-            name="conversion_by_channel",
-            description="Get 30-day conversion rate by acquisition channel for a signup cohort.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "cohort_start": {"type": "string", "format": "date"},
-                    "cohort_end": {"type": "string", "format": "date"},
-                },
-                "required": ["cohort_start", "cohort_end"],
-            },
-        ),
-        types.Tool(
-            name="feature_usage_by_segment",
-            description="Rank features by usage for a given plan tier over a date range.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "plan_tier": {"type": "string"},
-                    "start_date": {"type": "string", "format": "date"},
-                    "end_date": {"type": "string", "format": "date"},
-                },
-                "required": ["plan_tier", "start_date", "end_date"],
-            },
-        ),
-        types.Tool(
-            name="country_wow_change",
-            description="Detect week-over-week usage drops by country.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "week0_start": {"type": "string", "format": "date"},
-                    "week1_start": {"type": "string", "format": "date"},
-                    "drop_threshold": {"type": "number"},
-                },
-                "required": ["week0_start", "week1_start"],
-            },
-        ),
+        types.Tool(name=metric.name, description=metric.summary, inputSchema=metric.input_schema())
+        for metric in METRICS.values()
     ]
 
 
+def _freshness(db) -> Optional[dict[str, Any]]:
+    snapshot = snapshot_of(db)
+    return snapshot.freshness() if snapshot is not None else None
+
+
+# both return (result, snapshot freshness or None)
+def _compute(tenant: Optional[str], fn, args: tuple, kwargs: dict[str, Any]) -> Any:
+    db = get_db(tenant)
+    try:
+        with query_slot(db):
+            return fn(db, *args, **kwargs), _freshness(db)
+    finally:
+        db.close()
+
+
+def _compute_since(
+    tenant: Optional[str], name: str, fn, args: tuple, kwargs: dict[str, Any], since_version
+) -> Any:
+    db = get_db(tenant)
+    try:
+        with query_slot(db):
+            return compute_since(db, name, fn, args, kwargs, since_version), _freshness(db)
+    finally:
+        db.close()
+
+
+def _is_error(content: list[types.TextContent]) -> bool:
+    return content[0].text.startswith('{"error":')
+
+
 @server.call_tool()
 async def handle_call_tool(
     name: str, arguments: dict[str, Any]
 ) -> list[types.TextContent]:
-    db = get_db()
+    if not _capture.enabled:
+        return await _call_tool(name, arguments)
+    started = time.time()
+    began = time.perf_counter()
     try:
-        if name == "activation_rate":
-            cs = date.fromisoformat(arguments["cohort_start"])
-            ce = date.fromisoformat(arguments["cohort_end"])
-            payload = {"activation_rate_7d": get_activation_rate(db, cs, ce)}
-
-        elif name == "wau_by_plan":
-            sd = date.fromisoformat(arguments["start_date"])
-            ed = date.fromisoformat(arguments["end_date"])
-            payload = get_wau_by_plan(db, sd, ed)
-
-        elif name == "feature_timeseries":
-            event_name = arguments["event_name"]
-            sd = date.fromisoformat(arguments["start_date"])
-            ed = date.fromisoformat(arguments["end_date"])
-            payload = get_feature_timeseries(db, event_name, sd, ed)
-
-        elif name == "conversion_by_channel":
-            cs = date.fromisoformat(arguments["cohort_start"])
-            ce = date.fromisoformat(arguments["cohort_end"])
-            payload = get_conversion_by_channel(db, cs, ce)
-
-        elif name == "feature_usage_by_segment":
-            plan_tier = arguments["plan_tier"]
-            sd = date.fromisoformat(arguments["start_date"])
-            ed = date.fromisoformat(arguments["end_date"])
-            payload = get_feature_usage_by_segment(db, plan_tier, sd, ed)
-
-        elif name == "country_wow_change":
-            w0 = date.fromisoformat(arguments["week0_start"])
-            w1 = date.fromisoformat(arguments["week1_start"])
-            drop = float(arguments.get("drop_threshold", 0.2))
-            payload = get_country_wow_change(db, w0, w1, drop_threshold=drop)
+        content = await _call_tool(name, arguments)
+    except Exception:
+        _capture.record("mcp", name, arguments, started, time.perf_counter() - began, ok=False)
+        raise
+    _capture.record(
+        "mcp", name, arguments, started, time.perf_counter() - began, ok=not _is_error(content)
+    )
+    return content
 
+
+async def _call_tool(name: str, arguments: dict[str, Any]) -> list[types.TextContent]:
+    metric = METRICS.get(name)
+    if metric is None:
+        payload = {"error": f"Unknown tool: {name}"}
+        return [types.TextContent(type="text", text=dumps_text(payload))]
+
+    fn, args, kwargs = metric.parse(arguments)
+    try:
+        sample_buckets(kwargs["sample_rate"])
+    except ValueError as exc:
+        return [types.TextContent(type="text", text=dumps_text({"error": str(exc)}))]
+    if not metric.list_valued:
+        since_version = None
+    else:
+        try:
+            since = arguments.get("since")
+            since_version = None if since is None else decode_watermark(since)
+        except ValueError as exc:
+            return [types.TextContent(type="text", text=dumps_text({"error": str(exc)}))]
+
+    tenant = arguments.get("tenant")
+    # precomputed answers only cover the server's own database
+    entry = None
+    if since_version is None and tenant is None:
+        entry = _precomputed.lookup(make_key(name, args, kwargs))
+    changes = None
+    snapshot = None
+    try:
+        if entry is not None:
+            result = entry.value
+            if metric.list_valued:
+                changes = {"watermark": entry.watermark}
+        elif not metric.list_valued:
+            result, snapshot = await _inflight.do_async(
+                make_key(name, args, {**kwargs, "tenant": tenant}),
+                lambda: _compute(tenant, fn, args, kwargs),
+            )
         else:
-            payload = {"error": f"Unknown tool: {name}"}
+            payload, snapshot = await _inflight.do_async(
+                make_key(name, args, {**kwargs, "since_version": since_version, "tenant": tenant}),
+                lambda: _compute_since(tenant, name, fn, args, kwargs, since_version),
+            )
+            # shared with coalesced callers, so copy rather than pop
+            result = payload["items"]
+            changes = {k: v for k, v in payload.items() if k != "items"}
+    except TenantBusy as exc:
+        return [types.TextContent(type="text", text=dumps_text({"error": str(exc)}))]
+
+    content = [
+        types.TextContent(
+            type="text",
+            text=dumps_text(metric.payload(result)),
+        )
+    ]
+    if changes is not None:
+        content.append(types.TextContent(type="text", text=dumps_text(changes)))
+    if entry is not None:
+        content.append(
+            types.TextContent(type="text", text=dumps_text({"precomputed": entry.freshness()}))
+        )
+    if snapshot is not None:
+        content.append(types.TextContent(type="text", text=dumps_text({"snapshot": snapshot})))
+    return content
+
+
+class _StreamableHTTPEndpoint:
+    # ASGI callable so Starlette routes /mcp without a trailing-slash redirect.
+    def __init__(self, manager: StreamableHTTPSessionManager):
+        self.manager = manager
+
+    async def __call__(self, scope, receive, send) -> None:
+        await self.manager.handle_request(scope, receive, send)
+
 
-        return [
-            types.TextContent(
-                type="text",
-                text=json.dumps(payload),
+def create_http_app(
+    max_sessions: int = 100, session_idle_timeout: float = 600.0
+) -> Starlette:
+    """Streamable HTTP app serving many MCP sessions from this process.
+
+    All sessions share the module-level engine pool, the in-flight
+    coalescer and the precomputed cache. Opening a session beyond
+    `max_sessions` gets a 503 until an existing one closes or idles out.
+    """
+    manager = StreamableHTTPSessionManager(
+        app=server,
+        max_sessions=max_sessions,
+        session_idle_timeout=session_idle_timeout,
+    )
+
+    @asynccontextmanager
+    async def lifespan(app: Starlette):
+        _snapshots.start()
+        _precomputed.start()
+        _tenants.start()
+        try:
+            async with manager.run():
+                yield
+        finally:
+            _tenants.stop()
+            _precomputed.stop()
+            _snapshots.stop()
+            _capture.close()
+
+    return Starlette(
+        routes=[Route("/mcp", endpoint=_StreamableHTTPEndpoint(manager))],
+        lifespan=lifespan,
+    )
+
+
+async def run_stdio() -> None:
+    _snapshots.start()
+    # agent_cli starts a stdio server per question, so warming answers it
+    # almost never asks for would only compete with its one call
+    if "ANALYTICS_PRECOMPUTE" in os.environ:
+        _precomputed.start()
+    _tenants.start()
+    try:
+        async with stdio_server() as (read_stream, write_stream):
+            await server.run(
+                read_stream,
+                write_stream,
+                server.create_initialization_options(),
             )
-        ]
     finally:
-        db.close()
+        _tenants.stop()
+        _precomputed.stop()
+        _snapshots.stop()
+        _capture.close()
 
 
-async def main() -> None:
-    async with stdio_server() as (read_stream, write_stream):
-        await server.run(
-            read_stream,
-            write_stream,
-            server.create_initialization_options(),
-        )
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Analytics MCP server")
+    parser.add_argument("--transport", choices=["stdio", "http"], default="stdio")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--max-sessions",
+        type=int,
+        default=int(os.environ.get("MCP_MAX_SESSIONS", "100")),
+    )
+    parser.add_argument(
+        "--capture",
+        metavar="PATH",
+        help="append each tool call to this JSONL file (default: ANALYTICS_CAPTURE)",
+    )
+    opts = parser.parse_args()
+    if opts.capture:
+        _capture.path = opts.capture
+
+    if opts.transport == "stdio":
+        asyncio.run(run_stdio())
+        return
+
+    uvicorn.run(
+        create_http_app(max_sessions=opts.max_sessions),
+        host=opts.host,
+        port=opts.port,
+    )
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
\ No newline at end of file
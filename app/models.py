@@ -6,11 +6,15 @@ from sqlalchemy import (
     DateTime,
     ForeignKey,
     Enum,
+    Computed,
+    Index,
 )
 from sqlalchemy.dialects.sqlite import JSON
 from sqlalchemy.orm import relationship
 
+from .buckets import event_day_default, event_week_default
 from .db import Base
+from .sampling import sample_bucket_default
 
 
 class PlanTierEnum(str):
@@ -34,10 +38,14 @@ class Users(Base):
     plan_tier = Column(String, index=True)  # values from PlanTierEnum
     signup_date = Column(Date, index=True)
     acquisition_channel = Column(String, index=True)  # values from AcquisitionChannelEnum
+    # stable hash of user_id for sampled queries (app.sampling)
+    sample_bucket = Column(Integer, default=sample_bucket_default)
 
     company = relationship("Companies", back_populates="users")
     events = relationship("Events", back_populates="user")
 
+    __table_args__ = (Index("ix_users_sample", "sample_bucket", "signup_date"),)
+
 
 class Companies(Base):
     __tablename__ = "companies"
@@ -58,4 +66,100 @@ class Events(Base):
     event_time = Column(DateTime, index=True)
     event_metadata = Column("metadata", JSON, nullable=True)
 
+    # reporting-timezone buckets filled from event_time on insert
+    # (app.buckets): days since 1970-01-01, and the day number of the
+    # week's Monday
+    event_day = Column(Integer, default=event_day_default)
+    event_week = Column(Integer, default=event_week_default)
+    # the user's Users.sample_bucket, so sampled scans skip the join
+    sample_bucket = Column(Integer, default=sample_bucket_default)
+
+    # promoted metadata keys, extracted by SQLite into indexed virtual columns
+    meta_format = Column(
+        String, Computed("json_extract(metadata, '$.format')", persisted=False)
+    )
+    meta_platform = Column(
+        String, Computed("json_extract(metadata, '$.platform')", persisted=False)
+    )
+
     user = relationship("Users", back_populates="events")
+
+    __table_args__ = (
+        Index("ix_events_meta_format_day", "meta_format", "event_name", "event_day", "user_id"),
+        Index(
+            "ix_events_meta_platform_day", "meta_platform", "event_name", "event_day", "user_id"
+        ),
+        Index("ix_events_user_time", "user_id", "event_time"),
+        Index("ix_events_name_day_user", "event_name", "event_day", "user_id"),
+        Index("ix_events_day_week_user", "event_day", "event_week", "user_id", "event_name"),
+        Index("ix_events_sample", "sample_bucket", "event_day", "event_name", "user_id"),
+        Index(
+            "ix_events_name_sample", "event_name", "sample_bucket", "event_day", "user_id", "event_time"
+        ),
+    )
+
+
+class EventRollups(Base):
+    """Per user/day/event counts standing in for raw events compacted by
+    app.retention. Keeps the promoted metadata columns so metadata filters
+    still apply to compacted history."""
+
+    __tablename__ = "event_rollups"
+
+    rollup_id = Column(Integer, primary_key=True)
+    user_id = Column(String, ForeignKey("users.user_id"), index=True)
+    event_name = Column(String, index=True)
+    event_day = Column(DateTime)  # midnight of the events' day
+    meta_format = Column(String)
+    meta_platform = Column(String)
+    event_count = Column(Integer)
+    # Events.event_day / event_week of the rolled-up rows
+    bucket_day = Column(Integer)
+    bucket_week = Column(Integer)
+    sample_bucket = Column(Integer)
+
+    __table_args__ = (
+        Index("ix_event_rollups_day_event", "event_day", "event_name"),
+        Index("ix_event_rollups_bucket_day", "bucket_day"),
+        Index("ix_event_rollups_name_sample", "event_name", "sample_bucket", "bucket_day"),
+    )
+
+
+class EventDayVersions(Base):
+    """Last change per event day, bumped by triggers on events. Versions come
+    from one increasing sequence, so `version > watermark` finds every day
+    that changed after a watermark was issued."""
+
+    __tablename__ = "event_day_versions"
+
+    event_day = Column(Date, primary_key=True)
+    version = Column(Integer, nullable=False, index=True)
+
+
+def _bump_day_version(row: str) -> str:
+    # the reporting-timezone day, or the UTC day for rows not yet bucketed
+    day = f"COALESCE(date({row}.event_day * 86400, 'unixepoch'), date({row}.event_time))"
+    return (
+        "INSERT INTO event_day_versions (event_day, version) "
+        f"VALUES ({day}, "
+        "(SELECT COALESCE(MAX(version), 0) + 1 FROM event_day_versions)) "
+        "ON CONFLICT (event_day) DO UPDATE SET version = excluded.version;"
+    )
+
+
+# (re)created by app.init_db; every write to events marks its day(s) changed
+EVENT_DAY_VERSION_TRIGGERS = {
+    "events_day_version_insert": "AFTER INSERT ON events "
+    f"BEGIN {_bump_day_version('NEW')} END",
+    "events_day_version_update": "AFTER UPDATE ON events "
+    f"BEGIN {_bump_day_version('OLD')} {_bump_day_version('NEW')} END",
+    "events_day_version_delete": "AFTER DELETE ON events "
+    f"BEGIN {_bump_day_version('OLD')} END",
+}
+
+
+# metadata key -> extracted column; only these keys can be filtered on
+PROMOTED_METADATA_COLUMNS = {
+    "format": Events.meta_format,
+    "platform": Events.meta_platform,
+}
@@ -0,0 +1,224 @@
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .coalesce import make_key
+from .db import SessionLocal, engines
+from .registry import METRICS
+from .snapshots import Snapshot, snapshot_of
+from .tools import parse_call
+from .watermark import current_version, encode_watermark
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TARGETS = (
+    "activation_rate:last_week,"
+    "wau_by_plan:last_30_days,"
+    "conversion_by_channel:last_30_days,"
+    "country_wow_change:last_week,"
+    "weekly_active_accounts:last_30_days,"
+    "anomalies:last_week"
+)
+
+
+def _week_start(d: date) -> date:
+    return d - timedelta(days=d.weekday())
+
+
+# relative window -> [start, end) for a given day
+RELATIVE_WINDOWS: Dict[str, Callable[[date], Tuple[date, date]]] = {
+    "yesterday": lambda today: (today - timedelta(days=1), today),
+    "last_7_days": lambda today: (today - timedelta(days=7), today),
+    "last_30_days": lambda today: (today - timedelta(days=30), today),
+    "last_week": lambda today: (_week_start(today) - timedelta(days=7), _week_start(today)),
+    "this_month": lambda today: (today.replace(day=1), today + timedelta(days=1)),
+}
+
+
+def window_arguments(metric: str, start: date, end: date) -> Dict[str, Any]:
+    # Tool arguments the planner produces for this metric over [start, end).
+    window = METRICS[metric].window if metric in METRICS else None
+    if window == "cohort":
+        return {
+            "cohort_start": start.isoformat(),
+            "cohort_end": (end - timedelta(days=1)).isoformat(),
+        }
+    if window == "weeks":
+        week1 = _week_start(end - timedelta(days=1))
+        return {
+            "week0_start": (week1 - timedelta(days=7)).isoformat(),
+            "week1_start": week1.isoformat(),
+        }
+    if window == "end":
+        return {"end_date": end.isoformat()}
+    if window == "range":
+        return {"start_date": start.isoformat(), "end_date": end.isoformat()}
+    raise ValueError(f"Metric {metric!r} can't be precomputed from a date window alone")
+
+
+def parse_targets(raw: str) -> List[Tuple[str, str]]:
+    targets = []
+    for item in raw.split(","):
+        if not item.strip():
+            continue
+        metric, _, window = item.strip().partition(":")
+        if window not in RELATIVE_WINDOWS:
+            raise ValueError(f"Unknown relative window {window!r} in {item!r}")
+        window_arguments(metric, date.today(), date.today())
+        targets.append((metric, window))
+    return targets
+
+
+class Entry:
+    def __init__(
+        self,
+        metric: str,
+        window: str,
+        value: Any,
+        computed_at: datetime,
+        data_version: int,
+        watermark: str,
+        snapshot: Optional[Snapshot] = None,
+    ):
+        self.metric = metric
+        self.window = window
+        self.value = value
+        self.computed_at = computed_at
+        self.data_version = data_version
+        self.watermark = watermark
+        self.snapshot = snapshot
+
+    def freshness(self) -> Dict[str, Any]:
+        age = (datetime.now(timezone.utc) - self.computed_at).total_seconds()
+        freshness = {
+            "window": self.window,
+            "computed_at": self.computed_at.isoformat(),
+            "age_seconds": round(age, 3),
+        }
+        if self.snapshot is not None:
+            freshness["snapshot"] = self.snapshot.freshness()
+        return freshness
+
+
+class Precomputer:
+    # Background thread that keeps answers for (metric, relative window)
+    # pairs warm, refreshing on a cadence and whenever another connection
+    # commits to any shard (SQLite's PRAGMA data_version changes). When it
+    # reads from snapshots, commits are ignored and each new snapshot
+    # triggers the refresh instead.
+
+    def __init__(
+        self,
+        targets: List[Tuple[str, str]],
+        interval_seconds: float = 300.0,
+        poll_seconds: float = 5.0,
+        session_factory=SessionLocal,
+        watch_commits: bool = True,
+    ):
+        self.targets = targets
+        self.interval_seconds = interval_seconds
+        self.poll_seconds = poll_seconds
+        self.session_factory = session_factory
+        self.watch_commits = watch_commits
+        self.refreshes = 0
+        self.hits = 0
+        self._entries: Dict[Hashable, Entry] = {}
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls, session_factory=SessionLocal, watch_commits: bool = True) -> "Precomputer":
+        return cls(
+            parse_targets(os.environ.get("ANALYTICS_PRECOMPUTE", DEFAULT_TARGETS)),
+            interval_seconds=float(os.environ.get("ANALYTICS_PRECOMPUTE_INTERVAL", 300)),
+            session_factory=session_factory,
+            watch_commits=watch_commits,
+        )
+
+    def lookup(self, key: Hashable) -> Optional[Entry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+        return entry
+
+    def trigger(self) -> None:
+        # e.g. after an ingestion batch in this process
+        self._wake.set()
+
+    def refresh(self, data_version: int = 0) -> None:
+        today = date.today()
+        entries = {}
+        db = self.session_factory()
+        try:
+            # read first, so the watermark never runs ahead of the values
+            watermark = encode_watermark(current_version(db))
+            snapshot = snapshot_of(db)
+            for metric, window in self.targets:
+                start, end = RELATIVE_WINDOWS[window](today)
+                fn, args, kwargs = parse_call(metric, window_arguments(metric, start, end))
+                value = fn(db, *args, **kwargs)
+                entries[make_key(metric, args, kwargs)] = Entry(
+                    metric,
+                    window,
+                    value,
+                    datetime.now(timezone.utc),
+                    data_version,
+                    watermark,
+                    snapshot,
+                )
+        finally:
+            db.close()
+        # swap wholesale so entries for yesterday's windows drop out
+        self._entries = entries
+        self.refreshes += 1
+
+    def start(self) -> None:
+        if not self.targets or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="precompute", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "targets": [f"{m}:{w}" for m, w in self.targets],
+            "entries": len(self._entries),
+            "refreshes": self.refreshes,
+            "hits": self.hits,
+        }
+
+    def _run(self) -> None:
+        conns = [shard.raw_connection() for shard in engines]
+        try:
+            last_version = None
+            next_refresh = 0.0
+            while not self._stop.is_set():
+                # each shard's counter only grows, so the sum changes with any of them
+                version = sum(
+                    conn.execute("PRAGMA data_version").fetchone()[0] for conn in conns
+                )
+                due = time.monotonic() >= next_refresh or self._wake.is_set()
+                if due or (self.watch_commits and version != last_version):
+                    self._wake.clear()
+                    try:
+                        self.refresh(version)
+                    except Exception:
+                        # keep serving the previous entries until the next attempt
+                        logger.exception("precompute refresh failed")
+                    last_version = version
+                    next_refresh = time.monotonic() + self.interval_seconds
+                self._wake.wait(self.poll_seconds)
+        finally:
+            for conn in conns:
+                conn.close()
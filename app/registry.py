@@ -0,0 +1,415 @@
+import json
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+from . import analytics, schemas
+from .analytics import SampledRate
+from .filters import SegmentFilter
+from .models import PROMOTED_METADATA_COLUMNS
+
+# (analytics function, positional args after db, keyword args)
+Call = Tuple[Callable, tuple, Dict[str, Any]]
+
+USER_DIMENSION_NAMES = ("country", "plan_tier", "acquisition_channel")
+
+METADATA_FILTER_SCHEMA = {
+    "type": "object",
+    "description": "Exact-match filter on promoted event metadata keys "
+    f"({', '.join(sorted(PROMOTED_METADATA_COLUMNS))}).",
+    "additionalProperties": {"type": "string"},
+}
+
+# accepted by every metric; compiled into joins/predicates on users
+SEGMENT_FILTER_PROPERTIES = {
+    "country": {"type": "string"},
+    "plan_tier": {"type": "string", "enum": ["free", "pro", "enterprise"]},
+    "acquisition_channel": {"type": "string", "enum": ["organic", "paid", "referral"]},
+    "company_id": {"type": "string"},
+    "min_employees": {"type": "integer"},
+    "max_employees": {"type": "integer"},
+}
+
+# accepted by every metric; counts are scaled up from a stable subset of users
+SAMPLE_PROPERTY = {
+    "sample_rate": {
+        "type": "number",
+        "exclusiveMinimum": 0,
+        "maximum": 1,
+        "description": "Read only this fraction of users for an estimate; "
+        "rates come with 95% confidence intervals.",
+    },
+}
+
+# accepted by every list-valued metric
+SINCE_PROPERTY = {
+    "since": {
+        "type": "string",
+        "description": "Watermark from a previous call; only buckets changed since then are returned.",
+    },
+}
+
+
+# accepted by every metric; see app.tenants
+TENANT_PROPERTY = {
+    "tenant": {
+        "type": "string",
+        "description": "Team database to query; omit for the server's own database.",
+    },
+}
+
+
+def parse_list(raw: Optional[str]) -> Optional[List[str]]:
+    if not raw:
+        return None
+    return [item.strip() for item in raw.split(",") if item.strip()]
+
+
+def parse_metadata_filter(raw: Optional[str]) -> Optional[Dict[str, str]]:
+    # "format:csv,platform:web" -> {"format": "csv", "platform": "web"}
+    if not raw:
+        return None
+    parsed = {}
+    for pair in raw.split(","):
+        key, sep, value = pair.partition(":")
+        if not sep or not key.strip():
+            raise ValueError(f"Invalid metadata_filter: {pair!r}")
+        parsed[key.strip()] = value.strip()
+    return parsed
+
+
+@dataclass(frozen=True)
+class Param:
+    """One metric argument.
+
+    `kind` is "date", "string", "integer", "number", "list" (of strings) or
+    "metadata" (a metadata_filter). Required params are passed to the
+    analytics function positionally, in declaration order; optional ones
+    by keyword. For lists, `enum` constrains the items.
+    """
+
+    name: str
+    kind: str
+    required: bool = False
+    default: Any = None
+    enum: Optional[Tuple[str, ...]] = None
+    min_items: Optional[int] = None
+    hint: Optional[str] = None
+
+    def parse(self, arguments: Mapping[str, Any]) -> Any:
+        # tool arguments (JSON values) -> the analytics function's argument
+        value = arguments[self.name] if self.required else arguments.get(self.name, self.default)
+        if value is None:
+            return None
+        if self.kind == "date":
+            return date.fromisoformat(value)
+        if self.kind == "integer":
+            return int(value)
+        if self.kind == "number":
+            return float(value)
+        return value
+
+    def from_query(self, raw: Any) -> Any:
+        # HTTP query value -> tool argument; numbers arrive typed already
+        if self.kind == "list":
+            items = parse_list(raw)
+            return items if items or not self.required else []
+        if self.kind == "metadata":
+            return parse_metadata_filter(raw)
+        return raw
+
+    def json_schema(self) -> Dict[str, Any]:
+        if self.kind == "metadata":
+            return METADATA_FILTER_SCHEMA
+        if self.kind == "date":
+            return {"type": "string", "format": "date"}
+        if self.kind == "list":
+            items: Dict[str, Any] = {"type": "string"}
+            if self.enum:
+                items["enum"] = list(self.enum)
+            schema: Dict[str, Any] = {"type": "array", "items": items}
+            if self.min_items:
+                schema["minItems"] = self.min_items
+            return schema
+        schema = {"type": self.kind}
+        if self.enum:
+            schema["enum"] = list(self.enum)
+        return schema
+
+    def describe(self) -> str:
+        # for the planner prompt, e.g. 'grain ("day"|"week", default "week")'
+        notes = []
+        if self.kind == "date":
+            notes.append("YYYY-MM-DD")
+        choices = "|".join(f'"{value}"' for value in self.enum or ())
+        if self.kind == "list":
+            notes.append(f"list of {choices}" if choices else "list")
+        elif choices:
+            notes.append(choices)
+        if self.hint:
+            notes.append(self.hint)
+        if not self.required and self.default is None:
+            notes.append("optional")
+        elif not self.required:
+            notes.append(f"default {json.dumps(self.default)}")
+        return f"{self.name} ({', '.join(notes)})" if notes else self.name
+
+
+@dataclass(frozen=True)
+class Metric:
+    """A metric declared once; routes, tool schemas, dispatch and the
+    planner prompt are generated from it.
+
+    `dimensions` are the keys each result item is grouped by and
+    `aggregation` says what its values count. Scalar metrics name their
+    payload key in `result_key`; the rest return a list of items. `bucket`
+    is (grain, item key) for metrics a `since` poll can recompute bucket by
+    bucket, `unbounded` marks metrics that look back from their end date,
+    and `window` says how a precomputed relative date window maps onto the
+    arguments ("cohort", "weeks", "range" or "end").
+    """
+
+    name: str
+    fn: Callable
+    description: str
+    params: Tuple[Param, ...]
+    response_model: type
+    dimensions: Tuple[str, ...]
+    aggregation: str
+    result_key: Optional[str] = None
+    bucket: Optional[Tuple[str, str]] = None
+    unbounded: bool = False
+    window: Optional[str] = None
+    planner_hint: Optional[str] = None
+
+    @property
+    def list_valued(self) -> bool:
+        return self.result_key is None
+
+    @property
+    def summary(self) -> str:
+        if not self.dimensions:
+            return f"{self.description} Returns {self.aggregation}."
+        *rest, last = self.dimensions
+        per = f"{', '.join(rest)} and {last}" if rest else last
+        return f"{self.description} Returns {self.aggregation} per {per}."
+
+    def bind(
+        self,
+        arguments: Mapping[str, Any],
+        segment: Optional[SegmentFilter],
+        sample_rate: Optional[float],
+    ) -> Call:
+        args = tuple(p.parse(arguments) for p in self.params if p.required)
+        kwargs = {p.name: p.parse(arguments) for p in self.params if not p.required}
+        kwargs["segment"] = segment
+        kwargs["sample_rate"] = sample_rate
+        return self.fn, args, kwargs
+
+    def parse(self, arguments: Mapping[str, Any]) -> Call:
+        # Arguments are parsed into exactly what the HTTP routes pass, so both
+        # transports share coalescing and precomputed-result keys.
+        sample_rate = arguments.get("sample_rate")
+        if sample_rate is not None:
+            sample_rate = float(sample_rate)
+        return self.bind(arguments, SegmentFilter.from_args(arguments), sample_rate)
+
+    def from_query(self, query: Mapping[str, Any]) -> Dict[str, Any]:
+        return {
+            p.name: p.from_query(query[p.name])
+            for p in self.params
+            if query.get(p.name) is not None
+        }
+
+    def payload(self, result: Any) -> Any:
+        if self.result_key is None:
+            return result
+        if isinstance(result, SampledRate):
+            return {self.result_key: result.rate, f"{self.result_key}_ci": result.ci}
+        return {self.result_key: result}
+
+    def input_schema(self) -> Dict[str, Any]:
+        properties = {p.name: p.json_schema() for p in self.params}
+        properties.update(SEGMENT_FILTER_PROPERTIES)
+        properties.update(SAMPLE_PROPERTY)
+        properties.update(TENANT_PROPERTY)
+        if self.list_valued:
+            properties.update(SINCE_PROPERTY)
+        return {
+            "type": "object",
+            "properties": properties,
+            "required": [p.name for p in self.params if p.required],
+        }
+
+
+def _dates(*names: str) -> Tuple[Param, ...]:
+    return tuple(Param(name, "date", required=True) for name in names)
+
+
+COHORT = _dates("cohort_start", "cohort_end")
+RANGE = _dates("start_date", "end_date")
+WEEKS = _dates("week0_start", "week1_start")
+DROP_THRESHOLD = Param("drop_threshold", "number", default=0.2)
+METADATA_FILTER = Param(
+    "metadata_filter", "metadata", hint='e.g. {"format": "csv"}; keys: format, platform'
+)
+GRAIN = Param("grain", "string", default="week", enum=("day", "week"))
+
+
+METRICS: Dict[str, Metric] = {
+    metric.name: metric
+    for metric in (
+        Metric(
+            name="activation_rate",
+            fn=analytics.get_activation_rate,
+            description="Compute 7-day activation rate for a signup cohort.",
+            params=COHORT,
+            response_model=schemas.ActivationRateResponse,
+            dimensions=(),
+            aggregation="the share of the cohort active within 7 days of signup",
+            result_key="activation_rate_7d",
+            window="cohort",
+        ),
+        Metric(
+            name="wau_by_plan",
+            fn=analytics.get_wau_by_plan,
+            description="Get weekly active users by plan tier over a date range.",
+            params=RANGE,
+            response_model=schemas.WAUByPlanResponse,
+            dimensions=("week_start", "plan_tier"),
+            aggregation="distinct active users",
+            bucket=("week", "week_start"),
+            window="range",
+        ),
+        Metric(
+            name="feature_timeseries",
+            fn=analytics.get_feature_timeseries,
+            description="Get daily counts for a feature event over a date range.",
+            params=(Param("event_name", "string", required=True),) + RANGE + (METADATA_FILTER,),
+            response_model=schemas.FeatureTimeseriesResponse,
+            dimensions=("date", "event_name"),
+            aggregation="event count",
+            bucket=("day", "date"),
+        ),
+        Metric(
+            name="conversion_by_channel",
+            fn=analytics.get_conversion_by_channel,
+            description="Get 30-day conversion rate by acquisition channel for a signup cohort.",
+            params=COHORT,
+            response_model=schemas.ConversionByChannelResponse,
+            dimensions=("acquisition_channel",),
+            aggregation="cohort size, users upgraded within 30 days and their rate",
+            window="cohort",
+        ),
+        Metric(
+            name="feature_usage_by_segment",
+            fn=analytics.get_feature_usage_by_segment,
+            description="Rank features by usage for a given plan tier over a date range.",
+            params=(Param("plan_tier", "string", required=True, hint='"free"|"pro"|"enterprise"'),)
+            + RANGE
+            + (METADATA_FILTER,),
+            response_model=schemas.FeatureUsageBySegmentResponse,
+            dimensions=("event_name",),
+            aggregation="event count and distinct users",
+        ),
+        Metric(
+            name="country_wow_change",
+            fn=analytics.get_country_wow_change,
+            description="Detect week-over-week usage drops by country.",
+            params=WEEKS + (DROP_THRESHOLD,),
+            response_model=schemas.CountryWoWChangeResponse,
+            dimensions=("country",),
+            aggregation="weekly active users in each week and their change",
+            window="weeks",
+        ),
+        Metric(
+            name="weekly_active_accounts",
+            fn=analytics.get_weekly_active_accounts,
+            description=(
+                "Get weekly active accounts (companies with any active user) over a date range."
+            ),
+            params=RANGE,
+            response_model=schemas.WeeklyActiveAccountsResponse,
+            dimensions=("week_start",),
+            aggregation="distinct active companies and users",
+            bucket=("week", "week_start"),
+            window="range",
+        ),
+        Metric(
+            name="company_active_seats",
+            fn=analytics.get_company_active_seats,
+            description="Rank companies by active seats (distinct active users) over a date range.",
+            params=RANGE + (Param("limit", "integer", default=100),),
+            response_model=schemas.CompanyActiveSeatsResponse,
+            dimensions=("company_id",),
+            aggregation="seats, distinct active users and utilization",
+            window="range",
+        ),
+        Metric(
+            name="company_wow_change",
+            fn=analytics.get_company_wow_change,
+            description="Detect week-over-week active seat drops by company.",
+            params=WEEKS + (DROP_THRESHOLD,),
+            response_model=schemas.CompanyWoWChangeResponse,
+            dimensions=("company_id",),
+            aggregation="active seats in each week and their change",
+            window="weeks",
+        ),
+        Metric(
+            name="cohort_retention",
+            fn=analytics.get_cohort_retention,
+            description="Signup-cohort x periods-since-signup retention matrix in one pass.",
+            params=COHORT
+            + (
+                Param("activity_events", "list", hint="event names"),
+                GRAIN,
+                Param("max_periods", "integer", default=12),
+                Param("dimension", "string", enum=USER_DIMENSION_NAMES),
+            ),
+            response_model=schemas.CohortRetentionResponse,
+            dimensions=("cohort_start", "segment", "period"),
+            aggregation="cohort size, active users and retention",
+            window="cohort",
+        ),
+        Metric(
+            name="funnel",
+            fn=analytics.get_funnel,
+            description=(
+                "Ordered funnel conversion for a list of events within a conversion window. "
+                "Steps with the same timestamp count as done in order."
+            ),
+            params=(Param("steps", "list", required=True, min_items=2, hint="ordered event names"),)
+            + RANGE
+            + (
+                Param("window_days", "integer", default=14),
+                Param("breakdown", "string", enum=USER_DIMENSION_NAMES),
+            ),
+            response_model=schemas.FunnelResponse,
+            dimensions=("segment", "step"),
+            aggregation="users reaching each step and step-to-step conversion",
+        ),
+        Metric(
+            name="anomalies",
+            fn=analytics.get_anomalies,
+            description=(
+                "Scan every (country/plan/channel value, event) series for the latest "
+                "period against a rolling baseline and return the top movers."
+            ),
+            params=(
+                Param("end_date", "date", required=True),
+                GRAIN,
+                Param("baseline_periods", "integer", default=4),
+                Param("dimensions", "list", enum=USER_DIMENSION_NAMES),
+                Param("measure", "string", default="users", enum=("users", "events")),
+                Param("top_k", "integer", default=10),
+                Param("min_volume", "integer", default=5),
+            ),
+            response_model=schemas.AnomaliesResponse,
+            dimensions=("dimension", "value", "event_name"),
+            aggregation="the latest period against its baseline, as a z-score",
+            unbounded=True,
+            window="end",
+            planner_hint='use for open-ended questions like "what changed?" or "any problems?"',
+        ),
+    )
+}
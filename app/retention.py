@@ -0,0 +1,226 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import DateTime, delete, func, insert, literal, literal_column, select
+
+from .db import engine, engines
+from .models import EventRollups, Events
+
+logger = logging.getLogger(__name__)
+
+events = Events.__table__
+rollups = EventRollups.__table__
+rowid = literal_column("events.rowid")
+
+GROUP_COLUMNS = ["user_id", "event_name", "meta_format", "meta_platform"]
+ROLLUP_COLUMNS = [
+    "user_id",
+    "event_name",
+    "event_day",
+    "meta_format",
+    "meta_platform",
+    "bucket_day",
+    "bucket_week",
+    "sample_bucket",
+    "event_count",
+]
+
+
+def archive_path(archive_dir: str, day: date) -> str:
+    return os.path.join(archive_dir, f"events-{day.isoformat()}.jsonl.gz")
+
+
+def _append_archive(path: str, rows) -> None:
+    # gzip members concatenate, so each batch is appended as its own member
+    lines = [
+        json.dumps(
+            {
+                "event_id": event_id,
+                "user_id": user_id,
+                "event_name": event_name,
+                "event_time": event_time.isoformat(),
+                "metadata": metadata,
+            },
+            separators=(",", ":"),
+        )
+        for _, event_id, user_id, event_name, event_time, metadata in rows
+    ]
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _compact_batch(conn, day_start: datetime, rows) -> None:
+    ids = [row[0] for row in rows]
+    aggregated = (
+        select(
+            events.c.user_id,
+            events.c.event_name,
+            literal(day_start, DateTime),
+            events.c.meta_format,
+            events.c.meta_platform,
+            events.c.event_day,
+            events.c.event_week,
+            events.c.sample_bucket,
+            func.count(),
+        )
+        .where(rowid.in_(ids))
+        .group_by(
+            *(events.c[name] for name in GROUP_COLUMNS),
+            events.c.event_day,
+            events.c.event_week,
+            events.c.sample_bucket,
+        )
+    )
+    conn.execute(insert(rollups).from_select(ROLLUP_COLUMNS, aggregated))
+    conn.execute(delete(events).where(rowid.in_(ids)))
+
+
+def _merge_rollups(day_start: datetime, shard) -> None:
+    # one row per key per day, whatever the number of batches or runs
+    with shard.begin() as conn:
+        last_id = conn.execute(
+            select(func.max(rollups.c.rollup_id)).where(rollups.c.event_day == day_start)
+        ).scalar()
+        if last_id is None:
+            return
+        old = (rollups.c.event_day == day_start) & (rollups.c.rollup_id <= last_id)
+        merged = (
+            select(
+                rollups.c.user_id,
+                rollups.c.event_name,
+                rollups.c.event_day,
+                rollups.c.meta_format,
+                rollups.c.meta_platform,
+                rollups.c.bucket_day,
+                rollups.c.bucket_week,
+                rollups.c.sample_bucket,
+                func.sum(rollups.c.event_count),
+            )
+            .where(old)
+            .group_by(
+                *(rollups.c[name] for name in GROUP_COLUMNS),
+                rollups.c.bucket_day,
+                rollups.c.bucket_week,
+                rollups.c.sample_bucket,
+            )
+        )
+        conn.execute(insert(rollups).from_select(ROLLUP_COLUMNS, merged))
+        conn.execute(delete(rollups).where(old))
+
+
+def compact_day(day: date, archive_dir: str, batch_size: int = 1000, shard=engine) -> int:
+    """Roll one day's raw events into event_rollups, archive and delete them.
+
+    Each batch is archived, rolled up and deleted in its own short
+    transaction, so writers are never locked out for long. A batch is
+    archived before its transaction commits: after a crash the archive
+    may repeat rows (deduplicate on event_id) but never miss any.
+    """
+    day_start = datetime.combine(day, datetime.min.time())
+    day_end = day_start + timedelta(days=1)
+    path = archive_path(archive_dir, day)
+    compacted = 0
+    while True:
+        with shard.begin() as conn:
+            rows = conn.execute(
+                select(
+                    rowid,
+                    events.c.event_id,
+                    events.c.user_id,
+                    events.c.event_name,
+                    events.c.event_time,
+                    events.c["metadata"],
+                )
+                .where(events.c.event_time >= day_start)
+                .where(events.c.event_time < day_end)
+                .order_by(rowid)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            _append_archive(path, rows)
+            _compact_batch(conn, day_start, rows)
+        compacted += len(rows)
+    _merge_rollups(day_start, shard)
+    return compacted
+
+
+def reclaim_space(step_pages: int = 1000, shard=engine) -> int:
+    """Return free pages to the OS in small steps; needs auto_vacuum=INCREMENTAL
+    (set by app.init_db)."""
+    with shard.connect() as conn:
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+            logger.warning("auto_vacuum is not INCREMENTAL; run python -m app.init_db")
+            return 0
+        start = free = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        conn.commit()
+        while free:
+            # sqlite3's execute() steps this pragma once (one page);
+            # executescript() runs it to completion
+            conn.connection.driver_connection.executescript(
+                f"PRAGMA incremental_vacuum({step_pages});"
+            )
+            free = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+            conn.commit()
+    return start
+
+
+def compact(
+    retention_days: int,
+    archive_dir: str = "archive",
+    batch_size: int = 1000,
+    today: Optional[date] = None,
+) -> Dict[str, int]:
+    """Compact every day of raw events older than `retention_days`, shard by
+    shard; shards append to the same daily archive files."""
+    cutoff = datetime.combine(
+        (today or date.today()) - timedelta(days=retention_days), datetime.min.time()
+    )
+    os.makedirs(archive_dir, exist_ok=True)
+    all_days = set()
+    compacted = freed_pages = 0
+    for index, shard in enumerate(engines):
+        with shard.connect() as conn:
+            days: List[date] = [
+                date.fromisoformat(d)
+                for (d,) in conn.execute(
+                    select(func.date(events.c.event_time))
+                    .where(events.c.event_time < cutoff)
+                    .distinct()
+                    .order_by(func.date(events.c.event_time))
+                )
+            ]
+
+        for day in days:
+            compacted += compact_day(day, archive_dir, batch_size, shard)
+            logger.info("compacted %s on shard %d", day, index)
+        all_days.update(days)
+        freed_pages += reclaim_space(shard=shard)
+
+    return {
+        "days": len(all_days),
+        "events": compacted,
+        "freed_pages": freed_pages,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compact and archive old raw events")
+    parser.add_argument("--days", type=int, default=90, help="raw events kept, in days")
+    parser.add_argument("--archive-dir", default="archive")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    print(compact(opts.days, opts.archive_dir, opts.batch_size))
+
+
+if __name__ == "__main__":
+    main()
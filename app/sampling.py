@@ -0,0 +1,57 @@
+import hashlib
+from math import sqrt
+from typing import List, Optional
+
+from sqlalchemy import func, literal_column
+
+# A user's sample bucket in [0, SAMPLE_BUCKETS); a sample_rate keeps the
+# users in buckets [0, rate * SAMPLE_BUCKETS), so samples are stable and
+# nested: every user in a 1% sample is also in the 5% one.
+SAMPLE_BUCKETS = 10_000
+
+
+def sample_bucket(user_id: str) -> int:
+    # personalized so it is independent of the shard hash (app.db.shard_for);
+    # otherwise a small sample would land on a single shard
+    digest = hashlib.blake2b(user_id.encode(), digest_size=8, person=b"sample").digest()
+    return int.from_bytes(digest, "big") % SAMPLE_BUCKETS
+
+
+def sample_bucket_default(context) -> int:
+    user_id = context.get_current_parameters().get("user_id")
+    return None if user_id is None else sample_bucket(user_id)
+
+
+def sample_buckets(sample_rate: Optional[float]) -> Optional[int]:
+    # number of buckets kept, or None to read every user
+    if sample_rate is None:
+        return None
+    if not 0 < sample_rate <= 1:
+        raise ValueError(f"sample_rate must be in (0, 1], got {sample_rate!r}")
+    buckets = max(1, round(sample_rate * SAMPLE_BUCKETS))
+    return None if buckets >= SAMPLE_BUCKETS else buckets
+
+
+def in_sample(column, buckets: int):
+    # likelihood() tells SQLite how selective the range is, so a small
+    # sample is read through the index leading with sample_bucket
+    fraction = literal_column(repr(buckets / SAMPLE_BUCKETS))
+    return func.likelihood(column < buckets, fraction)
+
+
+def scale(count: int, buckets: Optional[int]) -> int:
+    # a count over the sample, estimated for all users
+    if buckets is None:
+        return count
+    return round(count * SAMPLE_BUCKETS / buckets)
+
+
+def wilson_interval(successes: int, trials: int, z: float = 1.96) -> List[float]:
+    # 95% interval for a proportion of sampled users
+    if not trials:
+        return [0.0, 1.0]
+    p = successes / trials
+    denom = 1 + z * z / trials
+    center = (p + z * z / (2 * trials)) / denom
+    half = z * sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denom
+    return [max(0.0, center - half), min(1.0, center + half)]
@@ -1,9 +1,11 @@
-from typing import List, Optional
+from typing import Any, List, Optional
 from pydantic import BaseModel
 
 
 class ActivationRateResponse(BaseModel):
     activation_rate_7d: float
+    # 95% interval, only when sample_rate is set
+    activation_rate_7d_ci: Optional[List[float]] = None
 
 
 class WAUByPlanItem(BaseModel):
@@ -23,6 +25,7 @@ class ConversionByChannelItem(BaseModel):
     cohort_size: int
     converted: int
     conversion_rate_30d: float
+    conversion_rate_30d_ci: Optional[List[float]] = None
 
 
 class FeatureUsageBySegmentItem(BaseModel):
@@ -38,23 +41,113 @@ class CountryWoWChangeItem(BaseModel):
     change_pct: float
 
 
+class WeeklyActiveAccountsItem(BaseModel):
+    week_start: str
+    active_accounts: int
+    active_users: int
+
+
+class CompanyActiveSeatsItem(BaseModel):
+    company_id: str
+    company_name: Optional[str]
+    employee_count: Optional[int]
+    seats: int
+    active_seats: int
+    seat_utilization: float
+    seat_utilization_ci: Optional[List[float]] = None
+
+
+class CompanyWoWChangeItem(BaseModel):
+    company_id: str
+    company_name: Optional[str]
+    active_seats_week0: int
+    active_seats_week1: int
+    change_pct: float
+
+
+class CohortRetentionItem(BaseModel):
+    cohort_start: str
+    segment: Optional[str]
+    period: int
+    cohort_size: int
+    active_users: int
+    retention: float
+    retention_ci: Optional[List[float]] = None
+
+
+class FunnelStepItem(BaseModel):
+    segment: Optional[str]
+    step: int
+    event_name: str
+    users: int
+    conversion_from_start: float
+    conversion_from_previous: float
+    conversion_from_start_ci: Optional[List[float]] = None
+    conversion_from_previous_ci: Optional[List[float]] = None
+
+
+class AnomalyItem(BaseModel):
+    dimension: str
+    value: Optional[str]
+    event_name: str
+    period_start: str
+    current: int
+    baseline_mean: float
+    baseline_std: float
+    z_score: float
+    change_pct: Optional[float]
+
+
 # wrappers for list responses
 
-class WAUByPlanResponse(BaseModel):
+class ListResponse(BaseModel):
+    # Field order matches the payloads the routes send as is; subclasses
+    # narrow `items` in place. Unset fields are left out of responses.
+    items: List[Any]
+    # pass `watermark` back as `since` to get only changed buckets
+    watermark: Optional[str] = None
+    changed_buckets: Optional[List[str]] = None
+
+
+class WAUByPlanResponse(ListResponse):
     items: List[WAUByPlanItem]
 
 
-class FeatureTimeseriesResponse(BaseModel):
+class FeatureTimeseriesResponse(ListResponse):
     items: List[FeatureTimeseriesItem]
 
 
-class ConversionByChannelResponse(BaseModel):
+class ConversionByChannelResponse(ListResponse):
     items: List[ConversionByChannelItem]
 
 
-class FeatureUsageBySegmentResponse(BaseModel):
+class FeatureUsageBySegmentResponse(ListResponse):
     items: List[FeatureUsageBySegmentItem]
 
 
-class CountryWoWChangeResponse(BaseModel):
-    items: List[CountryWoWChangeItem]
\ No newline at end of file
+class CountryWoWChangeResponse(ListResponse):
+    items: List[CountryWoWChangeItem]
+
+
+class WeeklyActiveAccountsResponse(ListResponse):
+    items: List[WeeklyActiveAccountsItem]
+
+
+class CompanyActiveSeatsResponse(ListResponse):
+    items: List[CompanyActiveSeatsItem]
+
+
+class CompanyWoWChangeResponse(ListResponse):
+    items: List[CompanyWoWChangeItem]
+
+
+class CohortRetentionResponse(ListResponse):
+    items: List[CohortRetentionItem]
+
+
+class FunnelResponse(ListResponse):
+    items: List[FunnelStepItem]
+
+
+class AnomaliesResponse(ListResponse):
+    items: List[AnomalyItem]
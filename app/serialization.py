@@ -0,0 +1,37 @@
+import json
+from typing import Any
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # optional speedup, stdlib fallback below
+    orjson = None
+
+
+def dumps(payload: Any) -> bytes:
+    # Byte-for-byte the same as FastAPI's JSONResponse rendering.
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(
+        payload,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def dumps_text(payload: Any) -> str:
+    # MCP tool text: the stdlib's default output (", "/": " separators,
+    # ASCII escapes), byte-for-byte what the tools have always returned
+    return json.dumps(payload)
+
+
+class FastJSONResponse(Response):
+    # Returning this from a route skips response_model validation; the
+    # response_model on the decorator still drives the OpenAPI schema.
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
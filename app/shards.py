@@ -0,0 +1,208 @@
+import argparse
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy import Table, delete, func, insert, select
+from sqlalchemy.orm import Session
+
+from .db import SHARD_COUNT, engines, shard_engine, shard_for, shard_sessions
+from .init_db import init_engine
+from .models import Companies, EventRollups, Events, Users
+
+logger = logging.getLogger(__name__)
+
+companies = Companies.__table__
+users = Users.__table__
+events = Events.__table__
+rollups = EventRollups.__table__
+
+# tables partitioned by user_id, in the order their rows are written
+USER_TABLES = [users, events, rollups]
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=min(32, 4 * SHARD_COUNT), thread_name_prefix="shard"
+        )
+    return _executor
+
+
+def _on_shard(sessions, index: int, fn: Callable, args: tuple, kwargs: Dict[str, Any]) -> Any:
+    db = sessions[index]()
+    try:
+        return fn(db, *args, **kwargs)
+    finally:
+        db.close()
+
+
+def scatter(db: Session, fn: Callable, *args, **kwargs) -> List[Any]:
+    """Run `fn(session, *args, **kwargs)` on every shard in parallel.
+
+    Results come back in shard order. `db` serves shard 0 on the calling
+    thread, so a single-shard setup runs exactly as before. A snapshot
+    session (app.snapshots) carries its own shard sessions in `db.info`,
+    so every shard is read from the same snapshot.
+    """
+    if SHARD_COUNT == 1:
+        return [fn(db, *args, **kwargs)]
+    sessions = db.info.get("shard_sessions", shard_sessions)
+    futures = [
+        _pool().submit(_on_shard, sessions, index, fn, args, kwargs)
+        for index in range(1, SHARD_COUNT)
+    ]
+    first = fn(db, *args, **kwargs)
+    return [first] + [future.result() for future in futures]
+
+
+def _insert(engine, table: Table, rows: List[Dict[str, Any]]) -> None:
+    with engine.begin() as conn:
+        conn.execute(insert(table), rows)
+
+
+def insert_rows(table: Table, rows: Iterable[Dict[str, Any]]) -> int:
+    """Insert `rows` (dicts keyed by column name), each on its user's shard.
+
+    Rows of tables without a user_id column (companies) are copied to every
+    shard. Each shard's rows are written in one transaction on a thread of
+    their own, so writes to separate files proceed in parallel.
+    """
+    rows = list(rows)
+    if "user_id" in table.c:
+        batches: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        for row in rows:
+            batches[shard_for(row["user_id"])].append(row)
+    else:
+        batches = {index: rows for index in range(SHARD_COUNT)}
+    futures = [
+        _pool().submit(_insert, engines[index], table, batch)
+        for index, batch in batches.items()
+        if batch
+    ]
+    for future in futures:
+        future.result()
+    return len(rows)
+
+
+def _stored_columns(table: Table):
+    # generated columns are derived, and rollup ids are reassigned on the target
+    return [c for c in table.columns if c.computed is None and c.name != "rollup_id"]
+
+
+def _move_users(source, target, user_ids: List[str]) -> None:
+    with source.connect() as conn:
+        rows = {
+            table: conn.execute(
+                select(*_stored_columns(table)).where(table.c.user_id.in_(user_ids))
+            ).mappings().all()
+            for table in USER_TABLES
+        }
+    with target.begin() as conn:
+        # a rerun after a crash between the two transactions starts clean
+        conn.execute(delete(rollups).where(rollups.c.user_id.in_(user_ids)))
+        for table in USER_TABLES:
+            if rows[table]:
+                conn.execute(insert(table).prefix_with("OR IGNORE"), rows[table])
+    with source.begin() as conn:
+        for table in reversed(USER_TABLES):
+            conn.execute(delete(table).where(table.c.user_id.in_(user_ids)))
+
+
+def _rebalance_shard(index: int, to_count: int, batch_size: int) -> int:
+    source = shard_engine(index)
+    moved = 0
+    last_user = ""
+    while True:
+        with source.connect() as conn:
+            user_ids = conn.execute(
+                select(users.c.user_id)
+                .where(users.c.user_id > last_user)
+                .order_by(users.c.user_id)
+                .limit(batch_size)
+            ).scalars().all()
+        if not user_ids:
+            return moved
+        last_user = user_ids[-1]
+        by_target: Dict[int, List[str]] = defaultdict(list)
+        for user_id in user_ids:
+            target = shard_for(user_id, to_count)
+            if target != index:
+                by_target[target].append(user_id)
+        for target, ids in by_target.items():
+            _move_users(source, shard_engine(target), ids)
+            moved += len(ids)
+
+
+def rebalance(to_count: int, from_count: int = SHARD_COUNT, batch_size: int = 500) -> Dict[str, int]:
+    """Move users, with their events and rollups, onto the shards that
+    `to_count` assigns them.
+
+    Run it with writers stopped, then restart with ANALYTICS_SHARDS=to_count.
+    Each batch is copied, then deleted from its source, in two transactions:
+    an interrupted run leaves some users on both shards, and rerunning it
+    finishes the move. Thanks to the jump hash, growing from n shards only
+    moves users onto the new ones.
+    """
+    for index in range(from_count, to_count):
+        init_engine(shard_engine(index))
+    with shard_engine(0).connect() as conn:
+        company_rows = conn.execute(select(*_stored_columns(companies))).mappings().all()
+    if company_rows:
+        for index in range(1, to_count):
+            with shard_engine(index).begin() as conn:
+                conn.execute(insert(companies).prefix_with("OR IGNORE"), company_rows)
+
+    moved = 0
+    for index in range(from_count):
+        moved += _rebalance_shard(index, to_count, batch_size)
+        logger.info("rebalanced shard %d", index)
+    return {"shards": to_count, "moved_users": moved}
+
+
+def shard_sizes(count: int = SHARD_COUNT) -> List[Dict[str, int]]:
+    sizes = []
+    for index in range(count):
+        with shard_engine(index).connect() as conn:
+            sizes.append(
+                {
+                    "shard": index,
+                    "users": conn.execute(select(func.count()).select_from(users)).scalar(),
+                    "events": conn.execute(select(func.count()).select_from(events)).scalar(),
+                }
+            )
+    return sizes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Inspect or rebalance analytics shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("sizes", help="users and events per shard")
+    move = commands.add_parser("rebalance", help="spread users over a new shard count")
+    move.add_argument("--to", type=int, required=True, help="target shard count")
+    move.add_argument(
+        "--from",
+        dest="from_count",
+        type=int,
+        default=SHARD_COUNT,
+        help="current shard count (default: ANALYTICS_SHARDS)",
+    )
+    move.add_argument("--batch-size", type=int, default=500, help="users moved per transaction")
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if opts.command == "sizes":
+        for size in shard_sizes():
+            print(size)
+        return
+    print(rebalance(opts.to, opts.from_count, opts.batch_size))
+    if opts.to < opts.from_count:
+        print(f"shards {opts.to}..{opts.from_count - 1} are now empty and can be deleted")
+
+
+if __name__ == "__main__":
+    main()
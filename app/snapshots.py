@@ -0,0 +1,219 @@
+import glob
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from .db import SessionLocal, engines
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot:
+    # A read-only copy of every shard, taken one after another. The files
+    # never change once written, so they are opened immutable: readers take
+    # no locks at all, on them or on the live database.
+
+    def __init__(self, seq: int, paths: List[str], taken_at: datetime):
+        self.seq = seq
+        self.paths = paths
+        self.taken_at = taken_at
+        self.readers = 0
+        self.engines = [
+            create_engine(
+                f"sqlite:///file:{os.path.abspath(path)}?mode=ro&immutable=1&uri=true",
+                connect_args={"check_same_thread": False},
+            )
+            for path in paths
+        ]
+        self.sessions = [
+            sessionmaker(autocommit=False, autoflush=False, bind=shard) for shard in self.engines
+        ]
+
+    def freshness(self) -> Dict[str, Any]:
+        age = (datetime.now(timezone.utc) - self.taken_at).total_seconds()
+        return {
+            "snapshot": self.seq,
+            "taken_at": self.taken_at.isoformat(),
+            "age_seconds": round(age, 3),
+        }
+
+    def discard(self) -> None:
+        for shard in self.engines:
+            shard.dispose()
+        for path in self.paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class SnapshotSession(Session):
+    # Session on shard 0 of a snapshot; scatter() finds the other shards in
+    # `info`. Closing it releases the snapshot, so a retired snapshot is
+    # deleted once its last reader is done.
+
+    def __init__(self, manager: "SnapshotManager", snapshot: Snapshot):
+        super().__init__(
+            bind=snapshot.engines[0],
+            autoflush=False,
+            info={"snapshot": snapshot, "shard_sessions": snapshot.sessions},
+        )
+        self._manager = manager
+
+    def close(self) -> None:
+        super().close()
+        if self._manager is not None:
+            manager, self._manager = self._manager, None
+            manager.release(self.info["snapshot"])
+
+
+def snapshot_of(db: Session) -> Optional[Snapshot]:
+    return db.info.get("snapshot")
+
+
+def _backup(source_engine, path: str) -> None:
+    partial = path + ".partial"
+    source = source_engine.raw_connection()
+    try:
+        target = sqlite3.connect(partial)
+        try:
+            # all pages in one step: a single short read transaction on the
+            # live file, so the copy is consistent
+            source.driver_connection.backup(target)
+            # the copy is only ever read, with no journal or WAL beside it
+            target.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            target.close()
+    finally:
+        source.close()
+    os.replace(partial, path)
+
+
+class SnapshotManager:
+    """Background thread that copies every shard with SQLite's online
+    backup API every `interval_seconds`, and hands out sessions on the
+    newest copy.
+
+    Analytical scans then never hold a transaction open on the live files
+    that ingestion writes to. Until the first snapshot exists, or with an
+    interval of 0, sessions read the live database as before. A replaced
+    snapshot is retired and its files are deleted once its readers close.
+    """
+
+    def __init__(self, directory: str = "snapshots", interval_seconds: float = 0.0):
+        self.directory = directory
+        self.interval_seconds = interval_seconds
+        self.taken = 0
+        self._seq = 0
+        self._current: Optional[Snapshot] = None
+        self._retired: List[Snapshot] = []
+        self._listeners: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls) -> "SnapshotManager":
+        return cls(
+            directory=os.environ.get("ANALYTICS_SNAPSHOT_DIR", "snapshots"),
+            interval_seconds=float(os.environ.get("ANALYTICS_SNAPSHOT_INTERVAL", 0)),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval_seconds > 0
+
+    def subscribe(self, callback: Callable[[], None]) -> None:
+        # called after each new snapshot is published
+        self._listeners.append(callback)
+
+    def session(self) -> Session:
+        with self._lock:
+            snapshot = self._current
+            if snapshot is None:
+                return SessionLocal()
+            snapshot.readers += 1
+        return SnapshotSession(self, snapshot)
+
+    def release(self, snapshot: Snapshot) -> None:
+        with self._lock:
+            snapshot.readers -= 1
+            drained = snapshot.readers == 0 and snapshot in self._retired
+            if drained:
+                self._retired.remove(snapshot)
+        if drained:
+            snapshot.discard()
+
+    def take(self) -> Snapshot:
+        seq = self._seq + 1
+        paths = []
+        for index, shard in enumerate(engines):
+            path = os.path.join(self.directory, f"analytics-{seq}-shard-{index}.db")
+            _backup(shard, path)
+            paths.append(path)
+        snapshot = Snapshot(seq, paths, datetime.now(timezone.utc))
+        self._seq = seq
+        self._publish(snapshot)
+        self.taken += 1
+        return snapshot
+
+    def _publish(self, snapshot: Snapshot) -> None:
+        with self._lock:
+            previous, self._current = self._current, snapshot
+            drained = previous is not None and previous.readers == 0
+            if previous is not None and not drained:
+                self._retired.append(previous)
+        if drained:
+            previous.discard()
+        for callback in self._listeners:
+            callback()
+
+    def start(self) -> None:
+        if not self.enabled or self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # left behind by a previous process
+        for path in glob.glob(os.path.join(self.directory, "analytics-*-shard-*.db*")):
+            os.remove(path)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="snapshots", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            current, self._current = self._current, None
+            if current is not None and current.readers:
+                self._retired.append(current)
+                current = None
+        if current is not None:
+            current.discard()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            current = self._current
+            return {
+                "interval_seconds": self.interval_seconds,
+                "taken": self.taken,
+                "current": current.freshness() if current is not None else None,
+                "readers": current.readers if current is not None else 0,
+                "retired_waiting": len(self._retired),
+            }
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.take()
+            except Exception:
+                # keep serving the previous snapshot until the next attempt
+                logger.exception("snapshot failed")
+            self._stop.wait(self.interval_seconds)
@@ -0,0 +1,244 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from .db import SHARD_COUNT, shard_url
+
+logger = logging.getLogger(__name__)
+
+# a single directory name, so a tenant can't point outside the tenant root
+TENANT_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,63}")
+
+
+class TenantBusy(RuntimeError):
+    # every one of the tenant's query slots stayed taken for the whole wait
+    pass
+
+
+class Tenant:
+    # One tenant's shard engines. Each pool holds at most `max_concurrent`
+    # connections: a query uses one connection per shard, and the quota
+    # caps queries in flight, so the pool never has to wait.
+
+    def __init__(self, name: str, directory: str, max_concurrent: int):
+        self.name = name
+        self.engines = [
+            create_engine(
+                shard_url(index, directory),
+                connect_args={"check_same_thread": False},
+                pool_size=max_concurrent,
+                max_overflow=0,
+            )
+            for index in range(SHARD_COUNT)
+        ]
+        self.sessions = [
+            sessionmaker(autocommit=False, autoflush=False, bind=shard) for shard in self.engines
+        ]
+        self.quota = threading.BoundedSemaphore(max_concurrent)
+        # open sessions; a tenant is never evicted while it has any
+        self.active = 0
+        self.last_used = time.monotonic()
+
+    def dispose(self) -> None:
+        for shard in self.engines:
+            shard.dispose()
+
+
+class TenantSession(Session):
+    # Session on a tenant's shard 0; scatter() finds the other shards in
+    # `info`. Queries on it run inside query_slot(), so coalesced callers
+    # waiting on another's result don't take one of the tenant's slots.
+
+    def __init__(self, router: "TenantRouter", tenant: Tenant):
+        super().__init__(
+            bind=tenant.engines[0],
+            autoflush=False,
+            info={"tenant": tenant.name, "shard_sessions": tenant.sessions},
+        )
+        self._router = router
+        self._tenant = tenant
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        router, tenant = self._router, self._tenant
+        if not tenant.quota.acquire(timeout=router.wait_seconds):
+            router.rejected += 1
+            raise TenantBusy(
+                f"Tenant {tenant.name!r} already has {router.max_concurrent} queries running"
+            )
+        try:
+            yield
+        finally:
+            # hand the connections back with the slot, so the pool always
+            # has one for whoever takes the slot next
+            self.rollback()
+            tenant.quota.release()
+
+    def close(self) -> None:
+        super().close()
+        if self._router is not None:
+            router, self._router = self._router, None
+            router.release(self._tenant)
+
+
+def tenant_of(db: Session) -> Optional[str]:
+    return db.info.get("tenant")
+
+
+def query_slot(db: Session) -> ContextManager[None]:
+    # hold one of the tenant's query slots; no limit on the server's own database
+    if isinstance(db, TenantSession):
+        return db.slot()
+    return nullcontext()
+
+
+class TenantRouter:
+    """Sessions on per-tenant databases under `directory`.
+
+    Tenant `acme` reads `<directory>/acme/analytics.db` (plus
+    `analytics-shard-i.db` files with ANALYTICS_SHARDS > 1), laid out as
+    `python -m app.init_db` creates them when run in that directory.
+    Engines are opened on first use and kept in an LRU of at most
+    `max_engines` tenants. A background thread disposes of tenants unused
+    for `idle_seconds`, so their connections and file descriptors are
+    released. Each tenant runs at most `max_concurrent` queries at once
+    (see query_slot). A query waits up to `wait_seconds` for a slot, then
+    fails with TenantBusy. With no directory, routing is disabled.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        max_engines: int = 64,
+        idle_seconds: float = 300.0,
+        max_concurrent: int = 4,
+        wait_seconds: float = 5.0,
+    ):
+        self.directory = os.path.abspath(directory) if directory else None
+        self.max_engines = max_engines
+        self.idle_seconds = idle_seconds
+        self.max_concurrent = max_concurrent
+        self.wait_seconds = wait_seconds
+        self.opened = 0
+        self.evicted = 0
+        self.rejected = 0
+        self._tenants: "OrderedDict[str, Tenant]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls) -> "TenantRouter":
+        return cls(
+            directory=os.environ.get("ANALYTICS_TENANT_DIR"),
+            max_engines=int(os.environ.get("ANALYTICS_TENANT_MAX_ENGINES", 64)),
+            idle_seconds=float(os.environ.get("ANALYTICS_TENANT_IDLE", 300)),
+            max_concurrent=int(os.environ.get("ANALYTICS_TENANT_CONCURRENCY", 4)),
+            wait_seconds=float(os.environ.get("ANALYTICS_TENANT_WAIT", 5)),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def session(self, name: str) -> Session:
+        return TenantSession(self, self._acquire(name))
+
+    def release(self, tenant: Tenant) -> None:
+        with self._lock:
+            tenant.active -= 1
+            tenant.last_used = time.monotonic()
+
+    def _acquire(self, name: str) -> Tenant:
+        if not self.enabled:
+            raise ValueError("Tenant routing is disabled; set ANALYTICS_TENANT_DIR")
+        if not TENANT_NAME.fullmatch(name):
+            raise ValueError(f"Invalid tenant: {name!r}")
+        with self._lock:
+            tenant = self._tenants.get(name)
+            if tenant is not None:
+                self._tenants.move_to_end(name)
+                tenant.active += 1
+                return tenant
+        directory = os.path.join(self.directory, name)
+        # don't let a typo create an empty database
+        if not os.path.exists(os.path.join(directory, "analytics.db")):
+            raise ValueError(f"Unknown tenant: {name!r}")
+        tenant = Tenant(name, directory, self.max_concurrent)
+        with self._lock:
+            # another thread may have opened it meanwhile
+            existing = self._tenants.get(name)
+            if existing is None:
+                self._tenants[name] = tenant
+                tenant.active += 1
+                self.opened += 1
+                evicted = self._evict(lambda t: len(self._tenants) > self.max_engines)
+            else:
+                self._tenants.move_to_end(name)
+                existing.active += 1
+                evicted = [tenant]
+                tenant = existing
+        for stale in evicted:
+            stale.dispose()
+        return tenant
+
+    def _evict(self, over) -> List[Tenant]:
+        # least recently used first; tenants with queries in flight stay,
+        # so the cache can run over its bound until they finish
+        evicted = []
+        for name, tenant in list(self._tenants.items()):
+            if not over(tenant):
+                continue
+            if tenant.active == 0:
+                del self._tenants[name]
+                evicted.append(tenant)
+        self.evicted += len(evicted)
+        return evicted
+
+    def start(self) -> None:
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="tenants", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            tenants = list(self._tenants.values())
+            self._tenants.clear()
+        for tenant in tenants:
+            tenant.dispose()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "open": len(self._tenants),
+                "max_engines": self.max_engines,
+                "active": {t.name: t.active for t in self._tenants.values() if t.active},
+                "opened": self.opened,
+                "evicted": self.evicted,
+                "rejected": self.rejected,
+            }
+
+    def _run(self) -> None:
+        while not self._stop.wait(min(self.idle_seconds, 60.0)):
+            cutoff = time.monotonic() - self.idle_seconds
+            with self._lock:
+                evicted = self._evict(lambda t: t.last_used < cutoff)
+            for tenant in evicted:
+                tenant.dispose()
+            if evicted:
+                logger.info("closed %d idle tenant databases", len(evicted))
@@ -0,0 +1,14 @@
+from typing import Any, Dict, Optional
+
+from .registry import METRICS, Call
+
+
+def parse_call(name: str, arguments: Dict[str, Any]) -> Optional[Call]:
+    metric = METRICS.get(name)
+    if metric is None:
+        return None
+    return metric.parse(arguments)
+
+
+def tool_payload(name: str, result: Any) -> Any:
+    return METRICS[name].payload(result)
@@ -0,0 +1,126 @@
+import base64
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .analytics import GRAIN_DAYS
+from .db import SHARD_COUNT
+from .models import EventDayVersions
+from .registry import METRICS
+from .shards import scatter
+
+# one change version per shard; each shard counts its own
+Version = Tuple[int, ...]
+
+
+def encode_watermark(version: Version) -> str:
+    text = "v1:" + ".".join(str(v) for v in version)
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip("=")
+
+
+def decode_watermark(token: str) -> Version:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        prefix, _, text = raw.partition(":")
+        if prefix != "v1":
+            raise ValueError
+        version = tuple(int(v) for v in text.split("."))
+    except ValueError:
+        raise ValueError(f"Invalid watermark {token!r}")
+    if len(version) != SHARD_COUNT:
+        # issued before a rebalance; the client starts over with a full read
+        raise ValueError(f"Invalid watermark {token!r}")
+    return version
+
+
+def _shard_version(db: Session) -> int:
+    return db.query(func.coalesce(func.max(EventDayVersions.version), 0)).scalar()
+
+
+def current_version(db: Session) -> Version:
+    return tuple(scatter(db, _shard_version))
+
+
+def _shard_changes(db: Session, since: int) -> Dict[date, int]:
+    return dict(
+        db.query(EventDayVersions.event_day, EventDayVersions.version).filter(
+            EventDayVersions.version > since
+        )
+    )
+
+
+def changed_days(db: Session, since_version: Version) -> List[date]:
+    changes = scatter(db, _shard_changes, min(since_version))
+    return sorted(
+        {
+            d
+            for shard_changes, since in zip(changes, since_version)
+            for d, version in shard_changes.items()
+            if version > since
+        }
+    )
+
+
+def _bucket_start(d: date, grain: str) -> date:
+    if grain == "week":
+        return d - timedelta(days=d.weekday())
+    return d
+
+
+def compute_since(
+    db: Session,
+    name: str,
+    fn: Callable,
+    args: tuple,
+    kwargs: Dict[str, Any],
+    since_version: Optional[Version] = None,
+) -> Dict[str, Any]:
+    """Items for a list-valued metric plus a watermark for the next poll.
+
+    With `since_version`, only buckets containing a day whose events
+    changed after that watermark are recomputed and returned, listed in
+    `changed_buckets`. Bucketed metrics recompute just the span covering
+    those buckets. Any other metric is a single bucket keyed by its first
+    date argument: it is recomputed in full or returned empty.
+
+    The watermark is read before the data, so a change landing mid-read
+    is returned again on the next poll rather than missed.
+    """
+    version = current_version(db)
+    watermark = encode_watermark(version)
+    if since_version is None:
+        return {"items": fn(db, *args, **kwargs), "watermark": watermark}
+
+    days = changed_days(db, since_version)
+    # metric.bucket: (bucket grain, item key holding the bucket's start date);
+    # unbounded metrics look back from their end date, so any change may matter
+    metric = METRICS[name]
+    if metric.bucket is None:
+        key = next(a for a in args if isinstance(a, date))
+        floor = None if metric.unbounded else key
+        if not any(floor is None or d >= floor for d in days):
+            return {"items": [], "watermark": watermark, "changed_buckets": []}
+        return {
+            "items": fn(db, *args, **kwargs),
+            "watermark": watermark,
+            "changed_buckets": [key.isoformat()],
+        }
+
+    grain, item_key = metric.bucket
+    *head, start_date, end_date = args
+    buckets = sorted({_bucket_start(d, grain) for d in days if start_date <= d < end_date})
+    if not buckets:
+        return {"items": [], "watermark": watermark, "changed_buckets": []}
+
+    span_start = max(start_date, buckets[0])
+    span_end = min(end_date, buckets[-1] + timedelta(days=GRAIN_DAYS[grain]))
+    wanted = [b.isoformat() for b in buckets]
+    wanted_set = set(wanted)
+    items = [
+        item
+        for item in fn(db, *head, span_start, span_end, **kwargs)
+        if item[item_key] in wanted_set
+    ]
+    return {"items": items, "watermark": watermark, "changed_buckets": wanted}
@@ -0,0 +1,138 @@
+import asyncio
+import socket
+import sys
+import threading
+import time
+from contextlib import AsyncExitStack
+from datetime import date, timedelta
+
+import httpx
+import uvicorn
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+from mcp.client.streamable_http import streamablehttp_client
+
+from app.mcp_server import create_http_app
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(max_sessions: int) -> uvicorn.Server:
+    config = uvicorn.Config(
+        create_http_app(max_sessions=max_sessions),
+        host="127.0.0.1",
+        port=free_port(),
+        log_level="error",
+    )
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+def url(server: uvicorn.Server) -> str:
+    return f"http://127.0.0.1:{server.config.port}/mcp"
+
+
+async def one_session(endpoint: str, arguments: dict) -> None:
+    async with streamablehttp_client(endpoint) as (read, write, _):
+        async with ClientSession(read, write) as session:
+            await session.initialize()
+            result = await session.call_tool("wau_by_plan", arguments)
+            assert not result.isError
+
+
+def wau_arguments() -> dict:
+    today = date.today()
+    return {
+        "start_date": (today - timedelta(days=30)).isoformat(),
+        "end_date": today.isoformat(),
+    }
+
+
+async def stdio_load(total: int) -> float:
+    # Baseline: a private server process per client, as before.
+    params = StdioServerParameters(command=sys.executable, args=["-m", "app.mcp_server"])
+    start = time.perf_counter()
+    for _ in range(total):
+        async with stdio_client(params) as (read, write):
+            async with ClientSession(read, write) as session:
+                await session.initialize()
+                result = await session.call_tool("wau_by_plan", wau_arguments())
+                assert not result.isError
+    return time.perf_counter() - start
+
+
+async def load(endpoint: str, total: int, concurrency: int) -> float:
+    arguments = wau_arguments()
+    gate = asyncio.Semaphore(concurrency)
+
+    async def bounded():
+        async with gate:
+            await one_session(endpoint, arguments)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(bounded() for _ in range(total)))
+    return time.perf_counter() - start
+
+
+async def over_limit(endpoint: str, limit: int) -> int:
+    # Hold `limit` sessions open, then try one more with a raw initialize.
+    async with AsyncExitStack() as stack:
+        for _ in range(limit):
+            read, write, _ = await stack.enter_async_context(streamablehttp_client(endpoint))
+            session = await stack.enter_async_context(ClientSession(read, write))
+            await session.initialize()
+        async with httpx.AsyncClient() as client:
+            resp = await client.post(
+                endpoint,
+                headers={"Accept": "application/json, text/event-stream"},
+                json={
+                    "jsonrpc": "2.0",
+                    "id": 1,
+                    "method": "initialize",
+                    "params": {
+                        "protocolVersion": "2025-06-18",
+                        "capabilities": {},
+                        "clientInfo": {"name": "bench", "version": "0"},
+                    },
+                },
+            )
+        return resp.status_code
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    stdio_total = max(1, total // 20)
+    elapsed = asyncio.run(stdio_load(stdio_total))
+    print(
+        f"stdio sessions={stdio_total} elapsed={elapsed:.2f}s "
+        f"sessions_per_sec={stdio_total / elapsed:.1f}"
+    )
+
+    server = serve(max_sessions=concurrency)
+    elapsed = asyncio.run(load(url(server), total, concurrency))
+    print(
+        f"http sessions={total} concurrency={concurrency} "
+        f"elapsed={elapsed:.2f}s sessions_per_sec={total / elapsed:.1f}"
+    )
+    server.should_exit = True
+
+    limit = 3
+    server = serve(max_sessions=limit)
+    status = asyncio.run(over_limit(url(server), limit))
+    print(f"session {limit + 1} with max_sessions={limit}: HTTP {status}")
+    server.should_exit = True
+    if status != 503:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
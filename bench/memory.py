@@ -0,0 +1,120 @@
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app import analytics
+from app.db import Base
+from app.init_db import backfill_event_buckets
+from app import models  # noqa: F401
+
+USERS = 2000
+EVENTS_PER_DAY = 2000
+EVENT_NAMES = ["login", "view_dashboard", "export_report", "invite_teammate", "upgrade_plan"]
+
+
+def build_db(path: str, days: int, end: date) -> None:
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    rng = random.Random(1)
+    start = end - timedelta(days=days)
+    users = [
+        (
+            f"u{i}",
+            rng.choice(["US", "UK", "DE"]),
+            rng.choice(["free", "pro", "enterprise"]),
+            (start + timedelta(days=rng.randint(0, days - 1))).isoformat(),
+            rng.choice(["organic", "paid", "referral"]),
+        )
+        for i in range(USERS)
+    ]
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "INSERT INTO users (user_id, country, plan_tier, signup_date, acquisition_channel) "
+            "VALUES (?, ?, ?, ?, ?)",
+            users,
+        )
+        n = 0
+        for d in range(days):
+            day = datetime.combine(start + timedelta(days=d), datetime.min.time())
+            rows = []
+            for _ in range(EVENTS_PER_DAY):
+                n += 1
+                rows.append(
+                    (
+                        f"e{n}",
+                        f"u{rng.randrange(USERS)}",
+                        rng.choice(EVENT_NAMES),
+                        (day + timedelta(seconds=rng.randrange(86400))).isoformat(" "),
+                        "{}",
+                    )
+                )
+            conn.exec_driver_sql(
+                "INSERT INTO events (event_id, user_id, event_name, event_time, metadata) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        backfill_event_buckets(conn)
+    engine.dispose()
+
+
+def peak_kib(fn) -> float:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def metrics(db: Session, start: date, end: date):
+    w1 = analytics._week_start(end - timedelta(days=7))
+    return {
+        "activation_rate": lambda: analytics.get_activation_rate(db, start, end),
+        "wau_by_plan": lambda: analytics.get_wau_by_plan(db, start, end),
+        "feature_timeseries": lambda: analytics.get_feature_timeseries(db, "login", start, end),
+        "conversion_by_channel": lambda: analytics.get_conversion_by_channel(db, start, end),
+        "feature_usage_by_segment": lambda: analytics.get_feature_usage_by_segment(
+            db, "pro", start, end
+        ),
+        "country_wow_change": lambda: analytics.get_country_wow_change(
+            db, start, w1, drop_threshold=-1.0
+        ),
+    }
+
+
+def main():
+    short_days = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    long_days = short_days * 10
+    end = date(2024, 1, 1)
+
+    print(f"stream chunk size: {analytics.STREAM_CHUNK_SIZE} rows")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        build_db(path, long_days, end)
+        engine = create_engine(f"sqlite:///{path}")
+        failed = False
+        with Session(engine) as db:
+            short = metrics(db, end - timedelta(days=short_days), end)
+            long = metrics(db, end - timedelta(days=long_days), end)
+            for name in short:
+                small = peak_kib(short[name])
+                large = peak_kib(long[name])
+                # 10x the range must stay within 2x the memory
+                ok = large <= small * 2
+                failed |= not ok
+                print(
+                    f"{name:26s} {short_days:4d}d={small:9.1f}KiB "
+                    f"{long_days:4d}d={large:9.1f}KiB {'ok' if ok else 'GREW'}"
+                )
+        engine.dispose()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from agent_cli import PlannerClient
+
+PLAN = {"tool_name": "wau_by_plan", "arguments": {"start_date": "2024-01-01", "end_date": "2024-01-31"}}
+
+
+class MockPlannerServer(ThreadingHTTPServer):
+    """Local OpenAI-compatible /chat/completions endpoint.
+
+    Answers every request with PLAN after `latency` seconds. The first
+    `fail_first` requests get a 503 so retry handling can be exercised.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0, fail_first: int = 0):
+        super().__init__(("127.0.0.1", 0), MockPlannerHandler)
+        self.latency = latency
+        self.fail_first = fail_first
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+
+class MockPlannerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server._lock:
+            self.server.requests += 1
+            failing = self.server.requests <= self.server.fail_first
+        time.sleep(self.server.latency)
+        if failing:
+            body = b'{"error": "unavailable"}'
+            self.send_response(503)
+        else:
+            content = json.dumps(PLAN)
+            body = json.dumps({"choices": [{"message": {"content": content}}]}).encode()
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(**kwargs) -> MockPlannerServer:
+    server = MockPlannerServer(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def unpooled(base_url: str, n: int) -> None:
+    # The old plan_tool: a bare requests.post per question.
+    for _ in range(n):
+        resp = requests.post(
+            f"{base_url}/chat/completions",
+            headers={"Authorization": "Bearer test", "Content-Type": "application/json"},
+            json={"model": "grok-3-mini", "messages": [], "temperature": 0},
+            timeout=60,
+        )
+        resp.raise_for_status()
+        assert json.loads(resp.json()["choices"][0]["message"]["content"]) == PLAN
+
+
+async def pooled(base_url: str, n: int) -> None:
+    async with PlannerClient("test", base_url=base_url) as planner:
+        for _ in range(n):
+            assert await planner.plan("show wau") == PLAN
+
+
+async def retried(base_url: str) -> None:
+    async with PlannerClient("test", base_url=base_url, backoff=0.01) as planner:
+        assert await planner.plan("show wau") == PLAN
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    timings = {}
+    for name, run in (
+        ("unpooled", lambda url: unpooled(url, n)),
+        ("pooled", lambda url: asyncio.run(pooled(url, n))),
+    ):
+        server = serve()
+        start = time.perf_counter()
+        run(server.base_url)
+        timings[name] = time.perf_counter() - start
+        print(
+            f"{name} requests={server.requests} connections={server.connections} "
+            f"per_request={timings[name] / n * 1000:.2f}ms"
+        )
+        server.shutdown()
+    print(f"speedup={timings['unpooled'] / timings['pooled']:.2f}x")
+
+    server = serve(fail_first=2)
+    asyncio.run(retried(server.base_url))
+    print(f"retry: succeeded after {server.requests} attempts")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import defaultdict
+from contextlib import AsyncExitStack
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+# entry -> True if the call succeeded
+Send = Callable[[Dict[str, Any]], Awaitable[bool]]
+
+
+def load(path: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda entry: entry["ts"])
+    return entries[:limit] if limit else entries
+
+
+def to_query(arguments: Dict[str, Any]) -> Dict[str, str]:
+    # MCP tool arguments -> the query string the HTTP route parses
+    query = {}
+    for key, value in arguments.items():
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            value = ",".join(f"{k}:{v}" for k, v in value.items())
+        elif isinstance(value, list):
+            value = ",".join(str(v) for v in value)
+        query[key] = str(value)
+    return query
+
+
+def to_tool_arguments(query: Dict[str, str], schema: Dict[str, Any]) -> Dict[str, Any]:
+    # HTTP query values -> MCP tool arguments, typed by the tool's input schema
+    properties = schema.get("properties", {})
+    arguments: Dict[str, Any] = {}
+    for key, raw in query.items():
+        kind = properties.get(key, {}).get("type")
+        if kind == "integer":
+            arguments[key] = int(raw)
+        elif kind == "number":
+            arguments[key] = float(raw)
+        elif kind == "array":
+            arguments[key] = [item.strip() for item in raw.split(",") if item.strip()]
+        elif kind == "object":
+            pairs = (pair.partition(":") for pair in raw.split(",") if pair)
+            arguments[key] = {k.strip(): v.strip() for k, _, v in pairs}
+        else:
+            arguments[key] = raw
+    return arguments
+
+
+async def http_sender(stack: AsyncExitStack, url: Optional[str]) -> Send:
+    if url is None:
+        # in process: the ASGI app is called directly, lifespan included
+        from app.main import app
+
+        await stack.enter_async_context(app.router.lifespan_context(app))
+        transport = httpx.ASGITransport(app=app)
+        client = httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=None)
+    else:
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        client = httpx.AsyncClient(base_url=url, limits=limits, timeout=None)
+    await stack.enter_async_context(client)
+
+    async def send(entry: Dict[str, Any]) -> bool:
+        arguments = entry["arguments"]
+        params = arguments if entry["transport"] == "http" else to_query(arguments)
+        resp = await client.get(f"/metrics/{entry['tool']}", params=params)
+        return resp.status_code < 400
+
+    return send
+
+
+async def mcp_sender(stack: AsyncExitStack, url: Optional[str]) -> Send:
+    from mcp import ClientSession
+
+    if url is None:
+        # in process: one client session over in-memory streams
+        from mcp.shared.memory import create_connected_server_and_client_session
+
+        from app.mcp_server import server
+
+        session = await stack.enter_async_context(
+            create_connected_server_and_client_session(server)
+        )
+    else:
+        from mcp.client.streamable_http import streamablehttp_client
+
+        read, write, _ = await stack.enter_async_context(streamablehttp_client(url))
+        session = await stack.enter_async_context(ClientSession(read, write))
+        await session.initialize()
+    schemas = {tool.name: tool.inputSchema for tool in (await session.list_tools()).tools}
+
+    async def send(entry: Dict[str, Any]) -> bool:
+        arguments = entry["arguments"]
+        if entry["transport"] == "http":
+            arguments = to_tool_arguments(arguments, schemas.get(entry["tool"], {}))
+        result = await session.call_tool(entry["tool"], arguments)
+        return not result.isError and not result.content[0].text.startswith('{"error":')
+
+    return send
+
+
+def offsets(
+    entries: List[Dict[str, Any]], rate: Optional[float], speed: Optional[float]
+) -> List[float]:
+    # seconds after the start at which each request is sent
+    if rate:
+        return [i / rate for i in range(len(entries))]
+    if speed:
+        first = entries[0]["ts"] if entries else 0.0
+        return [(entry["ts"] - first) / speed for entry in entries]
+    return [0.0] * len(entries)
+
+
+async def replay(
+    send: Send, entries: List[Dict[str, Any]], schedule: List[float], concurrency: int
+) -> Tuple[List[Tuple[str, float, bool]], float]:
+    gate = asyncio.Semaphore(concurrency)
+    results: List[Tuple[str, float, bool]] = []
+    start = time.perf_counter()
+
+    async def one(entry: Dict[str, Any], offset: float) -> None:
+        delay = offset - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with gate:
+            began = time.perf_counter()
+            try:
+                ok = await send(entry)
+            except Exception:
+                ok = False
+            results.append((entry["tool"], time.perf_counter() - began, ok))
+
+    await asyncio.gather(*(one(entry, offset) for entry, offset in zip(entries, schedule)))
+    return results, time.perf_counter() - start
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def report(
+    entries: List[Dict[str, Any]], results: List[Tuple[str, float, bool]], elapsed: float
+) -> None:
+    latencies = sorted(latency * 1000 for _, latency, _ in results)
+    errors = sum(not ok for _, _, ok in results)
+    total = len(results)
+    print(
+        f"requests={total} elapsed={elapsed:.2f}s "
+        f"throughput={total / elapsed if elapsed else 0.0:.1f} req/s "
+        f"errors={errors} ({100 * errors / total if total else 0.0:.1f}%)"
+    )
+    print(
+        f"latency_ms p50={percentile(latencies, 50):.1f} p90={percentile(latencies, 90):.1f} "
+        f"p99={percentile(latencies, 99):.1f} max={latencies[-1] if latencies else 0.0:.1f}"
+    )
+
+    captured: Dict[str, List[float]] = defaultdict(list)
+    for entry in entries:
+        captured[entry["tool"]].append(entry["duration_ms"])
+    by_tool: Dict[str, List[Tuple[float, bool]]] = defaultdict(list)
+    for tool, latency, ok in results:
+        by_tool[tool].append((latency * 1000, ok))
+    for tool in sorted(by_tool):
+        times = sorted(latency for latency, _ in by_tool[tool])
+        print(
+            f"  {tool:<26} n={len(times):<6} p50={percentile(times, 50):8.1f} "
+            f"p99={percentile(times, 99):8.1f} "
+            f"captured_p50={percentile(sorted(captured[tool]), 50):8.1f} "
+            f"errors={sum(not ok for _, ok in by_tool[tool])}"
+        )
+
+
+async def run(opts: argparse.Namespace) -> int:
+    entries = load(opts.capture, opts.limit)
+    if not entries:
+        print(f"{opts.capture}: no captured requests")
+        return 1
+    async with AsyncExitStack() as stack:
+        make_sender = http_sender if opts.target == "http" else mcp_sender
+        send = await make_sender(stack, opts.url)
+        schedule = offsets(entries, opts.rate, opts.speed)
+        results, elapsed = await replay(send, entries, schedule, opts.concurrency)
+    if opts.rate:
+        pace = f"rate={opts.rate}/s"
+    elif opts.speed:
+        pace = f"speed={opts.speed}x"
+    else:
+        pace = "unpaced"
+    print(
+        f"target={opts.target} url={opts.url or 'in-process'} "
+        f"concurrency={opts.concurrency} {pace}"
+    )
+    report(entries, results, elapsed)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a captured request log (ANALYTICS_CAPTURE) against the "
+        "HTTP API or the MCP server"
+    )
+    parser.add_argument("capture", help="JSONL file written by ANALYTICS_CAPTURE")
+    parser.add_argument("--target", choices=["http", "mcp"], default="http")
+    parser.add_argument(
+        "--url",
+        help="running server, e.g. http://127.0.0.1:8000 or http://127.0.0.1:8001/mcp "
+        "(default: call the app in process)",
+    )
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at most")
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument("--rate", type=float, help="send this many requests per second")
+    pace.add_argument(
+        "--speed", type=float, help="keep the captured spacing, sped up by this factor"
+    )
+    parser.add_argument("--limit", type=int, help="replay only the first N requests")
+    opts = parser.parse_args()
+    sys.exit(asyncio.run(run(opts)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import json
+import sys
+import time
+from datetime import date, timedelta
+
+from fastapi.encoders import jsonable_encoder
+
+from app.schemas import FeatureTimeseriesResponse, WAUByPlanResponse
+from app.serialization import dumps
+from app.watermark import encode_watermark
+
+
+def validated_path(model, payload) -> bytes:
+    # What FastAPI does for a plain dict returned under a response_model
+    # with response_model_exclude_unset, as the metric routes are.
+    content = jsonable_encoder(model(**payload), exclude_unset=True)
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def fast_path(model, payload) -> bytes:
+    return dumps(payload)
+
+
+def wau_payload(n: int):
+    start = date(2024, 1, 1)
+    plans = ["free", "pro", "enterprise"]
+    return {
+        "items": [
+            {
+                "week_start": (start + timedelta(weeks=i // 3)).isoformat(),
+                "plan_tier": plans[i % 3],
+                "wau": 1000 + i,
+            }
+            for i in range(n)
+        ],
+        "watermark": encode_watermark((n,)),
+    }
+
+
+def timeseries_payload(n: int):
+    start = date(2000, 1, 1)
+    return {
+        "items": [
+            {
+                "date": (start + timedelta(days=i)).isoformat(),
+                "event_name": "export_report",
+                "count": i * 7 % 1000,
+            }
+            for i in range(n)
+        ],
+        # as answered to a `since` poll
+        "watermark": encode_watermark((n,)),
+        "changed_buckets": [(start + timedelta(days=i)).isoformat() for i in range(n)],
+    }
+
+
+def bench(fn, model, payload, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(model, payload)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    cases = [
+        ("wau_by_plan", WAUByPlanResponse, wau_payload(n)),
+        ("feature_timeseries", FeatureTimeseriesResponse, timeseries_payload(n)),
+    ]
+    for name, model, payload in cases:
+        assert validated_path(model, payload) == fast_path(model, payload), name
+        slow = bench(validated_path, model, payload, repeat)
+        fast = bench(fast_path, model, payload, repeat)
+        print(
+            f"{name} rows={n} validated={slow * 1000:.2f}ms "
+            f"fast={fast * 1000:.2f}ms speedup={slow / fast:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
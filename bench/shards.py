@@ -0,0 +1,125 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+USERS = 2000
+COMPANIES = 50
+EVENT_NAMES = ["login", "view_dashboard", "export_report", "invite_teammate", "upgrade_plan"]
+END = date(2024, 1, 1)
+
+
+def ingest(total: int, batch: int) -> None:
+    # Runs in a child process: ANALYTICS_SHARDS and the working directory
+    # are set by the parent, since both are read at import time.
+    from app import analytics
+    from app.db import SessionLocal
+    from app.init_db import init_db
+    from app.models import Companies, Events, Users
+    from app.shards import insert_rows
+
+    init_db()
+    rng = random.Random(1)
+    start = END - timedelta(days=60)
+    insert_rows(
+        Companies.__table__,
+        [
+            {"company_id": f"c{i}", "company_name": f"Company {i}", "employee_count": 10}
+            for i in range(COMPANIES)
+        ],
+    )
+    insert_rows(
+        Users.__table__,
+        [
+            {
+                "user_id": f"u{i}",
+                "company_id": f"c{rng.randrange(COMPANIES)}",
+                "country": rng.choice(["US", "UK", "DE"]),
+                "plan_tier": rng.choice(["free", "pro", "enterprise"]),
+                "signup_date": start + timedelta(days=rng.randrange(60)),
+                "acquisition_channel": rng.choice(["organic", "paid", "referral"]),
+            }
+            for i in range(USERS)
+        ],
+    )
+    rows = [
+        {
+            "event_id": f"e{n}",
+            "user_id": f"u{rng.randrange(USERS)}",
+            "event_name": rng.choice(EVENT_NAMES),
+            "event_time": datetime.combine(start, datetime.min.time())
+            + timedelta(seconds=rng.randrange(60 * 86400)),
+            "metadata": {},
+        }
+        for n in range(total)
+    ]
+
+    began = time.perf_counter()
+    for i in range(0, total, batch):
+        insert_rows(Events.__table__, rows[i : i + batch])
+    elapsed = time.perf_counter() - began
+
+    db = SessionLocal()
+    try:
+        w1 = analytics._week_start(END - timedelta(days=7))
+        metrics = {
+            "wau_by_plan": analytics.get_wau_by_plan(db, start, END),
+            "weekly_active_accounts": analytics.get_weekly_active_accounts(db, start, END),
+            "company_active_seats": analytics.get_company_active_seats(db, start, END, limit=10),
+            "country_wow_change": analytics.get_country_wow_change(
+                db, w1 - timedelta(days=7), w1, drop_threshold=-1.0
+            ),
+            "cohort_retention": analytics.get_cohort_retention(db, start, END, max_periods=4),
+            "anomalies": analytics.get_anomalies(db, END, top_k=5),
+        }
+    finally:
+        db.close()
+    print(json.dumps({"elapsed": elapsed, "metrics": metrics}, default=str))
+
+
+def run(shards: int, total: int, batch: int) -> dict:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "ANALYTICS_SHARDS": str(shards), "PYTHONPATH": root}
+    with tempfile.TemporaryDirectory() as tmp:
+        out = subprocess.run(
+            [sys.executable, "-m", "bench.shards", "--child", str(total), str(batch)],
+            cwd=tmp,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    return json.loads(out.stdout)
+
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        ingest(int(sys.argv[2]), int(sys.argv[3]))
+        return
+
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    baseline = None
+    failed = False
+    for shards in (1, 2, 4):
+        result = run(shards, total, batch)
+        if baseline is None:
+            baseline = result
+        exact = result["metrics"] == baseline["metrics"]
+        failed |= not exact
+        print(
+            f"shards={shards} events={total} batch={batch} "
+            f"events_per_sec={total / result['elapsed']:,.0f} "
+            f"speedup={baseline['elapsed'] / result['elapsed']:.2f}x "
+            f"merged={'exact' if exact else 'DIFFERS'}"
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+USERS = 2000
+EVENTS = 100_000
+EVENT_NAMES = ["login", "view_dashboard", "export_report", "invite_teammate", "upgrade_plan"]
+END = date(2024, 1, 1)
+START = END - timedelta(days=60)
+
+
+def populate() -> None:
+    from app.init_db import init_db
+    from app.models import Events, Users
+    from app.shards import insert_rows
+
+    init_db()
+    rng = random.Random(1)
+    insert_rows(
+        Users.__table__,
+        [
+            {
+                "user_id": f"u{i}",
+                "country": rng.choice(["US", "UK", "DE"]),
+                "plan_tier": rng.choice(["free", "pro", "enterprise"]),
+                "signup_date": START + timedelta(days=rng.randrange(60)),
+                "acquisition_channel": rng.choice(["organic", "paid", "referral"]),
+            }
+            for i in range(USERS)
+        ],
+    )
+    insert_rows(Events.__table__, [event(rng, f"e{n}") for n in range(EVENTS)])
+
+
+def event(rng: random.Random, event_id: str) -> dict:
+    return {
+        "event_id": event_id,
+        "user_id": f"u{rng.randrange(USERS)}",
+        "event_name": rng.choice(EVENT_NAMES),
+        "event_time": datetime.combine(START, datetime.min.time())
+        + timedelta(seconds=rng.randrange(60 * 86400)),
+        "metadata": {},
+    }
+
+
+def read_loop(session_factory, stop: threading.Event, counter: list) -> None:
+    from app import analytics
+
+    while not stop.is_set():
+        db = session_factory()
+        try:
+            analytics.get_cohort_retention(db, START, END, max_periods=8)
+            analytics.get_anomalies(db, END, top_k=5)
+        finally:
+            db.close()
+        counter[0] += 1
+
+
+def run(mode: str, seconds: float, readers: int) -> None:
+    from app.db import SessionLocal
+    from app.models import Events
+    from app.shards import insert_rows
+    from app.snapshots import SnapshotManager
+
+    manager = SnapshotManager(directory="snapshots", interval_seconds=2.0)
+    if mode == "snapshot":
+        manager.start()
+        while manager.taken == 0:
+            time.sleep(0.01)
+        session_factory = manager.session
+    else:
+        session_factory = SessionLocal
+
+    stop = threading.Event()
+    reads = [0]
+    threads = [
+        threading.Thread(target=read_loop, args=(session_factory, stop, reads))
+        for _ in range(readers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    rng = random.Random(mode)
+    latencies, errors = [], 0
+    deadline = time.monotonic() + seconds
+    n = 0
+    while time.monotonic() < deadline:
+        rows = [event(rng, f"{mode}-{n + i}") for i in range(50)]
+        n += len(rows)
+        began = time.perf_counter()
+        try:
+            insert_rows(Events.__table__, rows)
+        except Exception:
+            # "database is locked" once the busy timeout runs out
+            errors += 1
+        latencies.append((time.perf_counter() - began) * 1000)
+        time.sleep(0.01)
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    manager.stop()
+
+    latencies.sort()
+    print(
+        f"{mode:<9} readers={readers} reads={reads[0]} commits={len(latencies) - errors} "
+        f"locked={errors} commit_ms p50={latencies[len(latencies) // 2]:.1f} "
+        f"p99={latencies[int(len(latencies) * 0.99)]:.1f} max={latencies[-1]:.1f} "
+        f"snapshots={manager.taken}"
+    )
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    with tempfile.TemporaryDirectory() as tmp:
+        # the engines resolve ./analytics.db when they first connect
+        os.chdir(tmp)
+        populate()
+        for mode in ("live", "snapshot"):
+            run(mode, seconds, readers)
+
+
+if __name__ == "__main__":
+    main()